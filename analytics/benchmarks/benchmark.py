@@ -0,0 +1,299 @@
+# Benchmarks for the analytics hot paths on synthetic price universes.
+#
+# Each benchmark times one hot path (returns, co-dispersion, the
+# optimizers, loading and the asset pre-assessment) over a grid of
+# universe sizes, number of assets x years of daily prices. The grids
+# are per benchmark as some paths are quadratic python loops (e.g.
+# the CoMAD co-dispersion) that could not finish at the largest sizes,
+# the 'full' profile goes up to 2000 assets and 50 years where the
+# path allows it.
+#
+# Every run is appended to a JSON history file. A run can be stored as
+# the baseline, later runs are compared to it by benchmark and size and
+# slowdowns beyond a tolerance are flagged (and give a non-zero exit).
+# Both files default to this dir and are local to the machine (git
+# ignores them).
+#
+# Usage (from the analytics dir):
+#   python benchmarks/benchmark.py --profile quick
+#   python benchmarks/benchmark.py --save-baseline
+#   python benchmarks/benchmark.py --only portOpt --tolerance 0.5
+#
+# There is no warranty or guarantee of any kind
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+
+import numpy as np
+
+# the analytics dir, this file lives in analytics/benchmarks
+analyticsDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, analyticsDir)
+
+from functions import genFin as gf
+from functions import genStats as gs
+from functions import portOpt as po
+from functions import assetPreassess as apa
+from data_mining import load
+from data_mining import synthetic
+
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+defaultHistory = os.path.join(benchDir, 'history.json')
+defaultBaseline = os.path.join(benchDir, 'baseline.json')
+
+# open trading days a year, as in genFin.annualize_factor
+daysPerYear = 252
+
+
+def make_universe(nAssets, nYears, nFactors=3, seed=0):
+    """Synthetic correlated daily price universe (see
+    data_mining.synthetic), all assets listed from the first day.
+
+    :param nAssets: int, number of assets
+    :param nYears:  float, years of daily (business day) prices
+    :param nFactors:    int, number of common factors
+    :param seed:    int, random seed
+    :return prices: float array 2D, rows as dates, cols as assets
+    :return dates:  datetime64 array, business days
+    :return syms:   str array, asset symbols
+    """
+    nDays = max(2, int(nYears * daysPerYear))
+    return synthetic.simulate_prices(nAssets, nDays, nFactors=nFactors,
+            lateListFrac=0, seed=seed)
+
+
+def _asset_stats(prices):
+    # monthly returns sampled every 20 rows, as the Portfolio defaults
+    r = gf.returns(prices, period=21)[::20]
+    return gf.returnExp(r, method='Normal'), gf.returnCoDispSq(r, method='Normal')
+
+
+# Each benchmark is a setup function of the universe, returning the
+# arguments, and the timed function of those arguments. Sizes are
+# (number of assets, years) per profile.
+
+def _setup_returns(prices, dates, syms, workDir):
+    return (prices,)
+
+def _run_returns(prices):
+    gf.returns(prices, period=21)
+
+def _setup_codisp(prices, dates, syms, workDir):
+    return (gf.returns(prices, period=21)[::20],)
+
+def _run_codisp_comad(r):
+    gs.codisper_sq(r, method='CoMAD')
+
+def _run_codisp_normal(r):
+    gs.codisper_sq(r, method='Normal')
+
+def _setup_comad(prices, dates, syms, workDir):
+    r = gf.returns(prices, period=1)
+    return r[:, 0], r[:, -1]
+
+def _run_comad(x, y):
+    gs.comad(x, y)
+
+def _setup_stats(prices, dates, syms, workDir):
+    return _asset_stats(prices)
+
+def _run_max_sharpe_ratio(rExps, rCoDispSq):
+    po.max_sharpe_ratio(rExps, rCoDispSq, annualizeBy='M')
+
+def _setup_frontier(prices, dates, syms, workDir):
+    rExps, rCoDispSq = _asset_stats(prices)
+    targets = np.linspace(np.min(rExps), np.max(rExps), 21)
+    return rExps, rCoDispSq, targets
+
+def _run_frontier(rExps, rCoDispSq, targets):
+    po.calc_efficient_frontier(rExps, rCoDispSq, targets, annualizeBy='M')
+
+def _setup_load(prices, dates, syms, workDir):
+    path = os.path.join(workDir, 'prices.csv')
+    # streamed by the generator, same size as the universe
+    nDays, nAssets = prices.shape
+    synthetic.write_prices_csv(path, nAssets, nDays, lateListFrac=0)
+    return (path,)
+
+def _run_load(path):
+    load.multiAssetHist_CSV(path, verb=False)
+
+def _setup_running_returns(prices, dates, syms, workDir):
+    return (prices[:, 0],)
+
+def _run_running_returns(x):
+    apa.calc_running_returns(x)
+
+
+benchmarks = {
+        'genFin.returns': (_setup_returns, _run_returns, {
+            'quick': [(10, 1), (200, 10)],
+            'full': [(10, 1), (200, 10), (2000, 10), (500, 50)]}),
+        'genStats.codisper_sq CoMAD': (_setup_codisp, _run_codisp_comad, {
+            'quick': [(10, 5), (30, 5)],
+            'full': [(10, 5), (50, 10), (100, 20)]}),
+        'genStats.codisper_sq Normal': (_setup_codisp, _run_codisp_normal, {
+            'quick': [(10, 5), (50, 5)],
+            'full': [(10, 5), (100, 10), (300, 20)]}),
+        'genStats.comad': (_setup_comad, _run_comad, {
+            'quick': [(2, 1), (2, 10)],
+            'full': [(2, 1), (2, 10), (2, 50)]}),
+        'portOpt.max_sharpe_ratio': (_setup_stats, _run_max_sharpe_ratio, {
+            'quick': [(10, 5), (50, 5)],
+            'full': [(10, 5), (100, 10), (500, 20)]}),
+        'portOpt.calc_efficient_frontier': (_setup_frontier, _run_frontier, {
+            'quick': [(10, 5), (30, 5)],
+            'full': [(10, 5), (50, 10), (200, 20)]}),
+        'load.multiAssetHist_CSV': (_setup_load, _run_load, {
+            'quick': [(10, 5), (100, 5)],
+            'full': [(10, 5), (500, 20), (2000, 10)]}),
+        'assetPreassess.calc_running_returns': (_setup_running_returns, _run_running_returns, {
+            'quick': [(1, 0.25), (1, 0.5)],
+            'full': [(1, 0.25), (1, 1), (1, 2)]})
+        }
+
+
+def time_call(func, args, repeat=3, maxSeconds=30):
+    """Best wall time of repeated calls, fewer repeats once the
+    calls have taken maxSeconds in total.
+
+    :param func:    function to time
+    :param args:    tuple, arguments of func
+    :param repeat:  int, maximum number of calls
+    :param maxSeconds:  float, time budget for the repeats
+    :return:    float, best time in seconds
+    """
+    best = np.inf
+    spent = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        dt = time.perf_counter() - t0
+        best = min(best, dt)
+        spent += dt
+        if spent > maxSeconds:
+            break
+    return best
+
+
+def run_benchmarks(profile='quick', only=None, repeat=3, seed=0, verb=True):
+    """Run the benchmarks for a profile.
+
+    :param profile: str, 'quick' or 'full' size grids
+    :param only:    str, run only benchmarks whose name contains this
+    :param repeat:  int, calls per timing (best is kept)
+    :param seed:    int, random seed of the universes
+    :param verb:    bool, print each result
+    :return:    dict, run record with a list of results
+                (benchmark, nAssets, nYears, seconds)
+    """
+    results = []
+    workDir = tempfile.mkdtemp(prefix='condor_bench_')
+    try:
+        for name, (setup, func, sizes) in benchmarks.items():
+            if only is not None and only not in name:
+                continue
+            for nAssets, nYears in sizes[profile]:
+                prices, dates, syms = make_universe(nAssets, nYears, seed=seed)
+                args = setup(prices, dates, syms, workDir)
+                seconds = time_call(func, args, repeat=repeat)
+                results.append({'benchmark': name, 'nAssets': nAssets,
+                    'nYears': nYears, 'seconds': seconds})
+                if verb:
+                    print('%-40s %5d assets %5g years %10.4fs' % (name, nAssets, nYears, seconds))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    return {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'profile': profile, 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(),
+            'results': results}
+
+
+def _result_key(result):
+    return (result['benchmark'], result['nAssets'], result['nYears'])
+
+
+def compare_to_baseline(run, baseline, tolerance=0.25):
+    """Compare a run to a baseline run by benchmark and size.
+
+    :param run: dict, run record (see run_benchmarks)
+    :param baseline:    dict, run record of the baseline
+    :param tolerance:   float, relative slowdown allowed before a
+                        result is flagged, 0.25 is 25% slower
+    :return:    list of dict, per result in both runs, with the baseline
+                seconds, the ratio (run / baseline) and a slowdown flag
+    """
+    baseTimes = {_result_key(res): res['seconds'] for res in baseline['results']}
+    comparison = []
+    for res in run['results']:
+        key = _result_key(res)
+        if key not in baseTimes:
+            continue
+        ratio = res['seconds'] / baseTimes[key]
+        comparison.append(dict(res, baseline=baseTimes[key], ratio=ratio,
+            slowdown=bool(ratio > 1 + tolerance)))
+    return comparison
+
+
+def append_history(run, path):
+    """Append a run record to the JSON history file (a list of runs)."""
+    history = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            history = json.load(f)
+    history.append(run)
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the analytics hot paths on synthetic universes.')
+    parser.add_argument('--profile', choices=['quick', 'full'], default='quick')
+    parser.add_argument('--only', default=None, help='run only benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--history', default=defaultHistory, help='JSON history file, runs are appended')
+    parser.add_argument('--baseline', default=defaultBaseline, help='JSON baseline run to compare to')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown that is flagged')
+    args = parser.parse_args(argv)
+
+    run = run_benchmarks(profile=args.profile, only=args.only, repeat=args.repeat,
+            seed=args.seed)
+    append_history(run, args.history)
+
+    nSlow = 0
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=1)
+        print('Baseline saved to '+args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        comparison = compare_to_baseline(run, baseline, tolerance=args.tolerance)
+        print('\nCompared to the baseline of '+baseline['timestamp']+':')
+        for res in comparison:
+            flag = 'SLOWER' if res['slowdown'] else ''
+            print('%-40s %5d assets %5g years %6.2fx %s' % (res['benchmark'], res['nAssets'],
+                res['nYears'], res['ratio'], flag))
+        nSlow = sum(res['slowdown'] for res in comparison)
+        if nSlow > 0:
+            print('Warning: '+str(nSlow)+' benchmarks are more than '+
+                    str(int(args.tolerance*100))+'% slower than the baseline.')
+    else:
+        print('No baseline at '+args.baseline+', run with --save-baseline to store one.')
+
+    return 1 if nSlow > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
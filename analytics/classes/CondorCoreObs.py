@@ -15,18 +15,28 @@ from functions import genStats as gs
 from functions import genFin as gf
 from functions import utils
 from functions import portOpt as po
+from functions import profiling
 
 from data_mining import load
+from data_mining import snapshot
 
 
 
 
 import numpy as np
 import datetime
+import copy
 
 # a small number that could be considered zero compared to 1.0
 eps = 1e-7
 
+# data sizes recorded when profiling (see functions/profiling.py)
+def _values_shape(self, *args, **kwargs):
+    return np.shape(self.values)
+
+def _portfolio_shape(self, *args, **kwargs):
+    return np.shape(self.prices.values)
+
 
 # default parameters 
 
@@ -35,7 +45,10 @@ defaultParams = {
         'method': 'Robust',
         'timeFrame': 'M',
         'annualize': True,
-        'sampInt': 20
+        'sampInt': 20,
+        'nFactors': None,
+        'calendar': False,
+        'ensemble': False
         }
 
 
@@ -56,6 +69,7 @@ class PriceLoader:
         # but we can keep all the info to quickly load what is needed
         self.syms = syms
 
+    @profiling.profiled('PriceLoader.get_assets_df')
     def get_assets_df(self,syms=None):
         # given a list of strings for asset syms return pandas data frame
         # rows as matching dates, cols as assets, values as listed under price header
@@ -93,6 +107,24 @@ class PriceLoader:
         
         return utils.df2np(df)
 
+    @profiling.profiled('PriceLoader.load_asset_set')
+    def load_asset_set(self,syms=None):
+        # given a list of strings for asset syms return an AssetSet 
+        # (one dates array, one symbol array and one price matrix)
+        # from a single read of the data file.
+        # Unlike the get methods this does not change the loader's 
+        # target symbols, if no syms are passed the preset ones are 
+        # used or all symbols in the file if none are set
+        if syms is None:
+            syms = self.syms
+        df = load.multiAssetHist_CSV(self.path, dateH=self.dateH, priceH=self.priceH, 
+                symH=self.symH, sep=self.sep, verb=False)
+        if syms is not None:
+            df = df[list(syms)]
+        prices, dates, syms = utils.df2np(df)
+
+        return AssetSet(syms, dates, prices, name=self.priceH, priceLoader=self)
+
     def get_assets(self,syms=None):
         # given a list of strings for asset syms return a list of asset objects
         # rows as matching dates, cols as assets, values as listed under price header
@@ -100,32 +132,17 @@ class PriceLoader:
         if syms is not None:
             self.set_target_asset_symbols(syms) 
 
-        # get the data
-        prices, dates, syms = self.get_assets_np(syms=self.syms)
-
-
-        # start making the assets
-        n = len(syms)
-        assets = []
-        for i in range(n):
-            # setup the data loader for the assets 
-            priceLoader = PriceLoader(self.path, dateH=self.dateH, priceH=self.priceH, 
-                symH=self.symH, syms=[syms[i]], sep=self.sep)
-            data = TimeCourse(dates,prices[:,i],name=self.priceH)
-            # at some point we may want to provide an option to the 
-            # user so that the name of the price header column 
-            # in the data file, does not need to be the same 
-            # as the time series data object name
-            # as we may be intrested in merging asset data from different files
-            # that use different string names for the same data
-
-            # we pass the price loader (for postarity) but we override it
-            # since we have all the data here. 
-            # why require the user to loop through and load each seperatly 
-            assets.append(Asset(syms[i], priceLoader, prices=data))
-
-
-        return assets
+        # get the data, one matrix for all the assets
+        # each asset is a view of its column (see AssetSet) and 
+        # shares this loader (for postarity), no per asset objects 
+        # are needed to hold the data
+        # at some point we may want to provide an option to the 
+        # user so that the name of the price header column 
+        # in the data file, does not need to be the same 
+        # as the time series data object name
+        # as we may be intrested in merging asset data from different files
+        # that use different string names for the same data
+        return self.load_asset_set(syms=self.syms).assets()
 
         
 
@@ -155,15 +172,55 @@ class TimeCourse:
 
     def _sample(self,array):
         # return the values, but properly sampled
-        n = len(array)
-        inds = np.arange(0,n,self.sampInt)
-        return array[inds]
+        # a strided view, no copy of the data
+        return array[::self.sampInt]
 
     def sample_values(self):
         # return the values, but properly sampled
         return self._sample(self.values)
     def sample_dates(self):
-        return self._sample(self.dates)
+        return self._sample(self.times)
+
+    def sample_phases(self):
+        # the values at every sampling phase (offset 0 to sampInt-1) at once,
+        # shaped (phase, sample, ...), phase k is values[k::sampInt] 
+        # so phase 0 is sample_values. A view when the length is a 
+        # multiple of sampInt, otherwise the phases with one sample less 
+        # are padded with nan (removed by the estimators)
+        values = self.values
+        nSamp = -(-len(values) // self.sampInt)
+        pad = nSamp*self.sampInt - len(values)
+        if pad > 0:
+            values = np.concatenate((values, np.full((pad,)+values.shape[1:], np.nan)))
+        values = values.reshape((nSamp, self.sampInt) + values.shape[1:])
+        return np.swapaxes(values, 0, 1)
+
+    # Date access, assuming the times are in temporal order (as Returns does).
+    # Dates can be anything numpy can make a datetime64 of 
+    # (e.g. '2020-01-31' or a datetime), lookups are binary searches
+    # and the results share the data with this TimeCourse (no copy)
+
+    def slice(self, start=None, end=None):
+        # a TimeCourse (of the same type, e.g. Returns) of the times 
+        # from start to end, both included, None leaves that side open
+        lo = 0
+        hi = len(self.times)
+        if start is not None:
+            lo = np.searchsorted(self.times, np.datetime64(start), side='left')
+        if end is not None:
+            hi = np.searchsorted(self.times, np.datetime64(end), side='right')
+        tc = copy.copy(self)
+        tc.times = self.times[lo:hi]
+        tc.values = self.values[lo:hi]
+        return tc
+
+    def at(self, date):
+        # the values at date, a view of the row if there are many assets
+        date = np.datetime64(date)
+        i = np.searchsorted(self.times, date, side='left')
+        if i == len(self.times) or self.times[i] != date:
+            raise Exception('The date '+str(date)+' is not in this TimeCourse.')
+        return self.values[i]
 
 # *** retrospectivly I am starting to think there should be either an 
 # AssetSet object that inherits from assets or Assets 
@@ -200,8 +257,9 @@ class Asset:
         self.priceLoader = priceLoader
         self.prices=prices
 
-        if self.priceLoader.syms[0] != sym:
-            raise Exception('Passed PriceLoader has a different symbol definintion than the symbol you passed. PriceLoader symbol, '+  priceLoader.syms[0] +', asset symbol '+sym)
+        # the loader can be shared by many assets (see AssetSet), 
+        # its target symbols do not matter as an asset always 
+        # loads its own symbol (see update_prices)
 
 
 
@@ -230,7 +288,7 @@ class Asset:
             # no price, then load data
             # a bit akward but if everything was defined correctly in its setup,
             # we just need (maybe later we can add some checks to loader):
-            prices = self.priceLoader.get_assets()[0].prices
+            prices = self.priceLoader.load_asset_set([self.sym]).asset(self.sym).prices
         
         # maybe later we can add some checks here on the prices, 
         # which by now were passed by the user or set above by the loader
@@ -295,25 +353,136 @@ class Asset:
 
         return self.prices
 
+    def save_snapshot(self, path):
+        # write the prices and, if calculated, the returns and their 
+        # statistics to a binary snapshot file (see data_mining/snapshot.py)
+        if self.get_prices_lastUpdated() is None:
+            raise Exception('Prices have never been updated, there is nothing to snapshot.')
+        arrays = {'dates': self.prices.times, 'prices': self.prices.values}
+        params = {'kind': 'Asset', 'sym': str(self.sym), 'priceName': self.prices.name,
+                'pricesLastUpdated': self.prices.lastUpdated.isoformat(), 
+                'sampInt': int(self.sampInt)}
+        if self.returns is not None:
+            _returns2snapshot(self.returns, arrays, params)
+            params['expectedReturn'] = float(self.expectedReturn)
+            params['returnDispersion'] = float(self.returnDispersion)
+
+        snapshot.write_snapshot(path, arrays, params)
+
+    @classmethod
+    def restore_snapshot(cls, path, priceLoader=None):
+        # an Asset from a snapshot file (see save_snapshot), nothing is 
+        # recalculated and the arrays are memory mapped (read only), 
+        # a priceLoader can be passed for later price updates
+        arrays, params = snapshot.read_snapshot(path)
+        if params.get('kind') != 'Asset':
+            raise Exception('The snapshot '+str(path)+' is not of an Asset.')
+        prices = TimeCourse(arrays['dates'], arrays['prices'], name=params['priceName'])
+        prices.lastUpdated = datetime.datetime.fromisoformat(params['pricesLastUpdated'])
+        asset = cls(params['sym'], priceLoader, prices=prices)
+        asset.sampInt = params['sampInt']
+        if 'returns' in params:
+            asset.returns = _snapshot2returns(arrays, params)
+            asset.expectedReturn = params['expectedReturn']
+            asset.returnDispersion = params['returnDispersion']
+
+        return asset
+
 
             
 
+class AssetSet:
+    # A set of assets held as arrays rather than a list of objects:
+    # one symbol array, one dates array and one price matrix 
+    # (rows as dates, cols as symbols), all assets share the dates.
+    # __slots__ keeps the object to just these, no per instance dict.
+    # Asset objects are made on request as views of a price column 
+    # (no copy), a Portfolio builds on the set directly
+    __slots__ = ('syms', 'dates', 'prices', 'name', 'priceLoader', 'lastUpdated', '_symInd')
+
+    def __init__(self, syms, dates, prices, name='Adj Close', priceLoader=None):
+        prices = np.asarray(prices)
+        if prices.ndim != 2 or prices.shape != (len(dates), len(syms)):
+            raise Exception('An AssetSet needs a price matrix with one row per date and one column per symbol.')
+        self.syms = np.asarray(syms)
+        self.dates = dates
+        self.prices = prices
+        self.name = name
+        self.priceLoader = priceLoader
+        self.lastUpdated = datetime.datetime.now()
+        self._symInd = {sym: i for i, sym in enumerate(self.syms)}
+
+    def __len__(self):
+        return len(self.syms)
+
+    def index(self, sym):
+        # column of sym in the price matrix
+        if sym not in self._symInd:
+            raise Exception('Symbol '+str(sym)+' is not in this asset set.')
+        return self._symInd[sym]
+
+    def get_prices(self):
+        # the price matrix as a TimeCourse (no copy), as used by Portfolio
+        prices = TimeCourse(self.dates, self.prices, name=self.name)
+        prices.lastUpdated = self.lastUpdated
+        return prices
+
+    def asset(self, sym):
+        # an Asset with its prices as a view of the sym column
+        prices = TimeCourse(self.dates, self.prices[:, self.index(sym)], name=self.name)
+        prices.lastUpdated = self.lastUpdated
+        return Asset(sym, self.priceLoader, prices=prices)
+
+    def assets(self):
+        # list of Asset views in symbol order
+        return [self.asset(sym) for sym in self.syms]
+
+    def subset(self, syms):
+        # a new set of just syms (in that order), the columns are copied 
+        inds = [self.index(sym) for sym in syms]
+        subset = AssetSet(self.syms[inds], self.dates, self.prices[:, inds], 
+                name=self.name, priceLoader=self.priceLoader)
+        subset.lastUpdated = self.lastUpdated
+        return subset
+
+
+
 class Returns(TimeCourse):
-    def __init__(self, prices, timeFrame='M', metric='Relative', method='Robust', sampInt=1):
+    @profiling.profiled('Returns', shapeOf=lambda self, prices, *args, **kwargs: np.shape(prices.values))
+    def __init__(self, prices, timeFrame='M', metric='Relative', method='Robust', sampInt=1,
+            nFactors=None, calendar=False, ensemble=False):
         # prices is a TimeCourse object
-        if timeFrame == 'D':
-            timePeriod = 1
-        elif timeFrame == 'M':
-            timePeriod = 21
-        elif timeFrame == 'Y':
-            timePeriod = 21*12
+        # nFactors - if set the co-dispersion squared matrix is a low rank 
+        # factor model (see genStats.FactorCoDispSq), multiplying it with 
+        # weights is O(n nFactors) instead of O(n^2)
+        # calendar - if true the return periods come from the price times,
+        # each return runs from a row to the first row one calendar period 
+        # (D, W, M, Q or Y) later (see genFin.calendar_returns), which 
+        # handles gaps in the data and data that is not daily
+        # ensemble - if true the estimates are the average over all sampInt 
+        # sampling phases rather than phase 0 only (see calc_ensemble)
+        if calendar:
+            values, ends = gf.calendar_returns(prices.values, prices.times, 
+                    timeFrame=timeFrame, metric=metric)
+            times = prices.times[ends]
         else:
-            raise Exception('The time frame '+timeFrame+' is not known.')
+            if timeFrame == 'D':
+                timePeriod = 1
+            elif timeFrame == 'W':
+                timePeriod = 5
+            elif timeFrame == 'M':
+                timePeriod = 21
+            elif timeFrame == 'Q':
+                timePeriod = 21*3
+            elif timeFrame == 'Y':
+                timePeriod = 21*12
+            else:
+                raise Exception('The time frame '+timeFrame+' is not known.')
 
-        # *** we are assuming every entry is a day and they are in temporal order
-        # in the futrue we should check this first ***
-        values = gf.returns(prices.values, period=timePeriod, metric=metric)
-        times = prices.times[timePeriod:]
+            # *** we are assuming every entry is a day and they are in temporal order
+            # in the futrue we should check this first ***
+            values = gf.returns(prices.values, period=timePeriod, metric=metric)
+            times = prices.times[timePeriod:]
 
         super().__init__(times, values, name = timeFrame+'ly '+metric+' Returns', sampInt=sampInt)
                 
@@ -321,15 +490,51 @@ class Returns(TimeCourse):
         self.timeFrame = timeFrame
         self.metric = metric 
         self.sampInt = sampInt
-
+        self.nFactors = nFactors
+        self.calendar = calendar
+        self.ensemble = ensemble
+        if ensemble and nFactors:
+            raise Exception('The ensemble estimate is not available with a factor model (nFactors).')
+        self._ensemble = None
+
+    @profiling.profiled('Returns.calc_ensemble', shapeOf=_values_shape)
+    def calc_ensemble(self):
+        # Estimates from every sampling phase, not just the sampled rows: 
+        # the (phase, sample, asset) values are estimated in one batched 
+        # pass and averaged (see genFin.ensemble_return_stats), 
+        # returns the expected returns, squared co-dispersion and 
+        # their spreads (std) over the phases, calculated once
+        if self._ensemble is None:
+            x = self.sample_phases()
+            if x.ndim == 2:
+                # a single asset
+                x = x[:, :, np.newaxis]
+            self._ensemble = gf.ensemble_return_stats(x, method=self.method)
+        return self._ensemble
+
+    def slice(self, start=None, end=None):
+        # as TimeCourse.slice, the ensemble estimate cached on this 
+        # object is of all its times, the slice calculates its own
+        tc = super().slice(start=start, end=end)
+        tc._ensemble = None
+        return tc
+
+    @profiling.profiled('Returns.calc_expected', shapeOf=_values_shape)
     def calc_expected(self):
+        if self.ensemble:
+            rExp = self.calc_ensemble()[0]
+            return rExp if self.values.ndim == 2 else rExp[0]
         return gf.returnExp(self.sample_values(), method=self.method)
 
+    @profiling.profiled('Returns.calc_dispersion', shapeOf=_values_shape)
     def calc_dispersion(self):
         # added a way to return co-dispersion squared if this is a matrix
+        if self.ensemble:
+            rCoDispSq = self.calc_ensemble()[1]
+            return rCoDispSq if self.values.ndim == 2 else np.sqrt(rCoDispSq[0, 0])
         x = self.sample_values()
         if len(x.shape)==2:
-            y = gf.returnCoDispSq(x,method=self.method) 
+            y = gf.returnCoDispSq(x,method=self.method,nFactors=self.nFactors) 
         else:
             y = gf.returnDisp(x, method=self.method)
 
@@ -339,10 +544,96 @@ class Returns(TimeCourse):
 
 
 
+# Returns objects and co-dispersion matrices in snapshots 
+# (see Asset.save_snapshot and Portfolio.save_snapshot)
+
+def _returns2snapshot(returns, arrays, params):
+    # add the returns to the snapshot arrays and params
+    arrays['returnTimes'] = returns.times
+    arrays['returnValues'] = returns.values
+    params['returns'] = {'name': returns.name, 'timeFrame': returns.timeFrame, 
+            'metric': returns.metric, 'method': returns.method, 
+            'sampInt': int(returns.sampInt), 'nFactors': returns.nFactors, 
+            'calendar': bool(returns.calendar), 'ensemble': bool(returns.ensemble), 
+            'lastUpdated': returns.lastUpdated.isoformat()}
+
+def _snapshot2returns(arrays, params):
+    # a Returns object from the snapshot, without recalculating the returns
+    info = params['returns']
+    returns = Returns.__new__(Returns)
+    TimeCourse.__init__(returns, arrays['returnTimes'], arrays['returnValues'], 
+            name=info['name'], sampInt=info['sampInt'])
+    returns.lastUpdated = datetime.datetime.fromisoformat(info['lastUpdated'])
+    returns.timeFrame = info['timeFrame']
+    returns.metric = info['metric']
+    returns.method = info['method']
+    returns.sampInt = info['sampInt']
+    returns.nFactors = info['nFactors']
+    returns.calendar = info['calendar']
+    returns.ensemble = info['ensemble']
+    returns._ensemble = None
+    return returns
+
+def _codisp2snapshot(rCoDispSq, arrays):
+    # a factor model is kept in factor form (see genStats.FactorCoDispSq)
+    if isinstance(rCoDispSq, gs.FactorCoDispSq):
+        arrays['coDispFactorLoadings'] = rCoDispSq.B
+        arrays['coDispSpecific'] = rCoDispSq.d
+    else:
+        arrays['returnCoDispersionSqMatrix'] = rCoDispSq
+
+def _snapshot2codisp(arrays):
+    if 'coDispFactorLoadings' in arrays:
+        return gs.FactorCoDispSq(arrays['coDispFactorLoadings'], arrays['coDispSpecific'])
+    return arrays['returnCoDispersionSqMatrix']
+
+
+
+class _LazyNode:
+    # One value in the Portfolio dependency graph (see Portfolio).
+    # A source node is set directly and each set moves its version on.
+    # A derived node has a compute function of its parents' values, 
+    # it is computed on first access and afterwards only recomputed 
+    # when the version of one of its parents has moved on since, 
+    # so a change only recomputes the nodes downstream of it.
+    __slots__ = ('compute', 'parents', 'version', '_value', '_parentVersions')
+
+    def __init__(self, compute=None, parents=(), value=None):
+        self.compute = compute
+        self.parents = parents
+        self.version = 0
+        self._value = value
+        self._parentVersions = None
+
+    def set(self, value):
+        # for source nodes
+        self._value = value
+        self.version += 1
+
+    def restore(self, value):
+        # for derived nodes, take value as computed from the current 
+        # parent values (e.g. from a snapshot), the parents must be 
+        # up to date already
+        self._value = value
+        self._parentVersions = tuple(parent.version for parent in self.parents)
+        self.version += 1
+
+    def get(self):
+        if self.compute is not None:
+            values = [parent.get() for parent in self.parents]
+            parentVersions = tuple(parent.version for parent in self.parents)
+            if parentVersions != self._parentVersions:
+                self._value = self.compute(*values)
+                self._parentVersions = parentVersions
+                self.version += 1
+        return self._value
+
+
+
 class Portfolio:
     def __init__(self, assets, weights, priceLoader=None):
         # a portfolio is just a list of assets (Assets or strs)
-        # and there weights (floats).
+        # and there weights (floats). An AssetSet can also be passed.
         # assets can be defined as a string of symbols iff there
         # is a priceLoader defined. This enables loading of all 
         # asset data from a single file, which can a bit faster
@@ -368,71 +659,176 @@ class Portfolio:
         if len(weights) != len(assets):
             raise Exception('Weights and assets must have the same length')
 
-        self.weights = np.array(weights) # just in case ;)
+        # Derived info is held in a small lazy dependency graph:
+        # prices, return params -> returns -> (expected return array, 
+        # co-dispersion squared matrix) -> weighted properties (with the 
+        # weights and annualize) -> optimal solutions (see optimal).
+        # The attributes of the same names read the graph, a node is 
+        # computed on first access and only recomputed once something 
+        # upstream of it has changed (see _LazyNode).
+        self._prices = _LazyNode()
+        self._weights = _LazyNode()
+        self._returnParams = _LazyNode()
+        self._annualize = _LazyNode()
+        self._returns = _LazyNode(self._calc_returns, (self._prices, self._returnParams))
+        self._expectedReturnArray = _LazyNode(
+                lambda returns: None if returns is None else returns.calc_expected(), 
+                (self._returns,))
+        self._returnCoDispersionSqMatrix = _LazyNode(
+                lambda returns: None if returns is None else returns.calc_dispersion(), 
+                (self._returns,))
+        self._properties = _LazyNode(self._calc_weighted_properties, (self._weights, 
+                self._returnParams, self._annualize, self._expectedReturnArray, 
+                self._returnCoDispersionSqMatrix))
 
-        # set prices from assets (utils can handle Assets or strs)
-        self.prices = utils.asset_list2prices(assets,priceLoader) 
+        self.weights = np.array(weights) # just in case ;)
 
-       
-        # deal with assets if strs
-        if type(assets[0]) is str:
+        # deal with assets if an AssetSet or strs
+        if isinstance(assets, AssetSet):
+            # already lined up, the assets are views of its columns
+            self.assetSet = assets
+            self.assets = self.assetSet.assets()
+        elif type(assets[0]) is str:
             if priceLoader is None:
                 raise Exception('If assets are defined by symbols you must define a PriceLoader to get the data for the assets.  A single file with all asset data must exist. Otherwise assets must be a list of Asset objects')
-            # need to make new assets out of str symbols
-            self.assets = []
-            for sym in assets:
-                tmpPriceLoader = priceLoader
-                tmpPriceLoader.set_target_asset_symbols([sym])
-                self.assets.append(Asset(sym,priceLoader))
+            # one read into an asset set, the assets are views of its columns
+            self.assetSet = priceLoader.load_asset_set(list(assets))
+            self.assets = self.assetSet.assets()
         else:
             # assuming this is already an asset object
+            # gather the asset prices, lined up by date, into a set
             self.assets = assets
+            prices = utils.asset_list2prices(assets)
+            self.assetSet = AssetSet(utils.asset_list_syms(assets), prices.times, 
+                    prices.values, name=prices.name, priceLoader=priceLoader)
 
+        # the price matrix for all calculations
+        self.prices = self.assetSet.get_prices()
 
-        
-        # book keeping stuff        
-        self.returns = None
-        self.expectedReturn = None
-        self.returnDispersion = None
-        self.expectedReturnArray = None
-        self.returnCoDispersionSqMatrix = None
 
+        
         # parameters we may want to persist later
         self.annualizeBy=None
         self.method=None
         self.metric=None
         self.timeFrame=None
         self.sampInt=None
+        self.nFactors=None
+        self.calendar=None
+        self.ensemble=None
+
+        # memo of optimal solutions (see optimal), only valid for the 
+        # versions of the asset statistics it was filled with
+        self._optimalMemo = {}
+        self._optimalMemoVersion = None
+
+
+    # the graph nodes as attributes
+    @property
+    def prices(self):
+        return self._prices.get()
+
+    @prices.setter
+    def prices(self, prices):
+        # new prices, everything downstream is stale
+        self._prices.set(prices)
+
+    @property
+    def weights(self):
+        return self._weights.get()
+
+    @weights.setter
+    def weights(self, weights):
+        # only an actual change moves the weighted properties on,
+        # a private copy is kept so edits to the caller's array can
+        # not change the weights behind the graph's back
+        if not np.array_equal(weights, self._weights.get()):
+            self._weights.set(np.array(weights, dtype=float))
+
+    @property
+    def annualize(self):
+        return self._annualize.get()
+
+    @annualize.setter
+    def annualize(self, annualize):
+        if annualize != self._annualize.get():
+            self._annualize.set(annualize)
+
+    @property
+    def returns(self):
+        return self._returns.get()
+
+    @property
+    def expectedReturnArray(self):
+        return self._expectedReturnArray.get()
+
+    @property
+    def returnCoDispersionSqMatrix(self):
+        return self._returnCoDispersionSqMatrix.get()
+
+    @property
+    def expectedReturn(self):
+        return self._properties.get()[0]
+
+    @property
+    def returnDispersion(self):
+        return self._properties.get()[1]
+
+    def _calc_returns(self, prices, returnParams):
+        # no returns until the return params are set (see update_returns)
+        if returnParams is None:
+            return None
+        timeFrame, metric, method, sampInt, nFactors, calendar, ensemble = returnParams
+        return Returns(prices, timeFrame=timeFrame, metric=metric, method=method, 
+                sampInt=sampInt, nFactors=nFactors, calendar=calendar, ensemble=ensemble)
+
+    @profiling.profiled('Portfolio.weighted_properties', shapeOf=_portfolio_shape)
+    def _calc_weighted_properties(self, weights, returnParams, annualize, 
+            expectedReturnArray, returnCoDispersionSqMatrix):
+        # expected return and return dispersion of the portfolio weights,
+        # none until returns and annualize are set (see update_properties)
+        if expectedReturnArray is None or annualize is None:
+            return None, None
+        if annualize:
+            annualizeBy = returnParams[0]
+        else:
+            annualizeBy = 'None'
+        return gf.asset_set_perform(weights, expectedReturnArray, 
+                returnCoDispersionSqMatrix, annualizeBy=annualizeBy)
 
-
+    @profiling.profiled('Portfolio.update_prices', shapeOf=_portfolio_shape)
     def update_prices(self):
         # Update all the prices from data and clear out derived info 
         # assuming these are correct asset objects in a list
         # which should have been dealt with in init
-        # need to loop through to trigger the update of all data
-        # *** Note if there is a price loader set here 
-        # it should indicate that you can load everything from one file
-        # for increased speed.
-        # you could get the prices from utils.asset_list2prices
-        # by passing the sym list (not the assets) and the loader
-        # but then your asset objects prices' could potentally be
-        # out of sync with the updated price matrix,
-        # you would need to recreate a new set of assets too either
-        # with the new prices or with no price
-        # the latter would be odd but it is easier and prvents a sync issue
-        # I am not going to deal with this now 
-        # but if we are commonly calling large asset sets from 
-        # a single file (I doubt it) then this would speed that up a lot***
-
-        for i in range( len(self.assets) ):
-            self.assets[i].update_prices()
-
-        self.prices = utils.asset_list2prices(self.assets)
-        self.returns=None
-        self.expectedReturn = None
-        self.returnDispersion = None
-        self.expectedReturnArray = None
-        self.returnCoDispersionSqMatrix = None
+        # Rather than each asset reloading the data file for itself, 
+        # there is one read per price loader for all the symbols using it,
+        # normally the assets share a single loader (see PriceLoader.get_assets) 
+        # so this is one read in total. Each asset's prices are then set 
+        # to a view of its column in that read, which keeps the asset 
+        # objects in sync with the portfolio price matrix.
+        loaders = []
+        for asset in self.assets:
+            if not any(asset.priceLoader is loader for loader in loaders):
+                loaders.append(asset.priceLoader)
+
+        for loader in loaders:
+            syms = [asset.sym for asset in self.assets if asset.priceLoader is loader]
+            assetSet = loader.load_asset_set(syms)
+            for asset in self.assets:
+                if asset.priceLoader is loader:
+                    asset.update_prices(prices=assetSet.asset(asset.sym).prices)
+
+        if len(loaders) == 1:
+            # one read, the prices are already lined up by date in the asset order
+            self.assetSet = assetSet
+        else:
+            # assets from different files, line them up by date
+            prices = utils.asset_list2prices(self.assets)
+            self.assetSet = AssetSet(utils.asset_list_syms(self.assets), prices.times, 
+                    prices.values, name=prices.name, priceLoader=self.assetSet.priceLoader)
+        # setting the prices node makes all derived info stale
+        self.prices = self.assetSet.get_prices()
 
     def get_returns_lastUpdated(self):
         # get the time stamp for when the prices were last updated
@@ -453,11 +849,14 @@ class Portfolio:
         return(stamp)
 
 
-    def update_returns(self, timeFrame=None, metric=None, method=None, sampInt=None):
+    def update_returns(self, timeFrame=None, metric=None, method=None, sampInt=None, 
+            nFactors=None, calendar=None, ensemble=None):
         # TimeCourse and return functions throughout should be such that 
         # they naturally handel the multi-asset (matrix) form
         # upon first use if parameters not passed then use defaulParams defined above
         # always store params after used which becomes the new default for this instance
+        # The returns are calculated on first access, and only if the 
+        # params or prices have changed since the last calculation
 
         if self.get_prices_lastUpdated() is None:
             raise Exception('Prices have never been updated.  You need prices to calculate the returns.')
@@ -510,37 +909,67 @@ class Portfolio:
         # set whatever value is used for the future 
         self.sampInt =sampInt
 
-        
-        self.returns = Returns(self.prices, timeFrame=timeFrame, metric=metric, 
-                method=method, sampInt=sampInt)
-        self.expectedReturnArray = self.returns.calc_expected()
-        self.returnCoDispersionSqMatrix = self.returns.calc_dispersion()
+        # setup params, a factor model for the co-dispersion (see Returns),
+        # 0 goes back to the full matrix
+        if nFactors is None:
+            if self.nFactors is None:
+                nFactors = defaultParams['nFactors']
+            else:
+                nFactors = self.nFactors
+        self.nFactors =nFactors
 
-        self.expectedReturn = None
-        self.returnDispersion = None
+        # setup params, calendar return periods (see Returns)
+        if calendar is None:
+            if self.calendar is None:
+                calendar = defaultParams['calendar']
+            else:
+                calendar = self.calendar
+        self.calendar =calendar
+
+        # setup params, ensemble over the sampling phases (see Returns)
+        if ensemble is None:
+            if self.ensemble is None:
+                ensemble = defaultParams['ensemble']
+            else:
+                ensemble = self.ensemble
+        self.ensemble =ensemble
+
+        returnParams = (timeFrame, metric, method, sampInt, nFactors, calendar, ensemble)
+        if returnParams != self._returnParams.get():
+            self._returnParams.set(returnParams)
        
     def set_weights(self, weights):
-        # setting weights will clear out weight dependnet properties
+        # setting weights only makes the weight dependent properties stale
         delta = np.abs(sum(weights)-1)
         if delta > eps:
             raise Exception('Weights must sum to 1. You are off by '+str(delta))
-        self.weights = weights
-
-        self.expectedReturn = None
-        self.returnDispersion = None
+        # always a new version, the weights array may have been 
+        # edited in place (e.g. p.weights[0] = ...) since the last set
+        self._weights.set(np.array(weights, dtype=float))
 
 
 
 
+    @profiling.profiled('Portfolio.update_properties', shapeOf=_portfolio_shape)
     def update_properties(self, weights=None, timeFrame=None, metric=None, 
-            method=None, annualize=None, sampInt=None):
+            method=None, annualize=None, sampInt=None, nFactors=None, calendar=None,
+            ensemble=None):
         # This updates all critical info starting with asset returns to portfolio returns.
         # One can change the weights if a new set of weigths is passed
-        self.update_returns(timeFrame=timeFrame, metric=metric, method=method)
-
-        # update the weights if passed
+        # Only what depends on a changed input is recalculated, e.g. new 
+        # weights or annualize leave the returns and co-dispersion as they are
+        self.update_returns(timeFrame=timeFrame, metric=metric, method=method, 
+                sampInt=sampInt, nFactors=nFactors, calendar=calendar, 
+                ensemble=ensemble)
+
+        # update the weights if passed, otherwise take the current 
+        # weights as new, they may have been edited in place 
+        # (e.g. p.weights[0] = ...), this only recalculates the 
+        # weighted properties
         if weights is not None:
             self.set_weights(weights)
+        else:
+            self._weights.set(self._weights.get())
 
         # setup params 
         if annualize is None:
@@ -554,18 +983,13 @@ class Portfolio:
         # set whatever value is used for the future 
         self.annualize =annualize
 
-        # to get this far a time frame would have been set
-        if annualize:
-            annualizeBy = self.timeFrame
-        else:
-            annualizeBy = 'None'
-
-        self.expectedReturn, self.returnDispersion = gf.asset_set_perform(self.weights, 
-                self.expectedReturnArray, self.returnCoDispersionSqMatrix, annualizeBy=annualizeBy)
+        # the weighted properties (expectedReturn, returnDispersion) 
+        # follow from the graph on first access
 
         
 
 
+    @profiling.profiled('Portfolio.calc_properties', shapeOf=_portfolio_shape)
     def calc_properties(self, weights=None, annualize=None, update=True):
         # this assumes asset expected returns and dispersion matrix exist, 
         # which would have required prices and returns.
@@ -582,9 +1006,14 @@ class Portfolio:
         # in this case we are both returning and overwriting
         # parameters are also overwritten to be default for this instance
         # you can avoid all overwriting by setting update to False
+        # weights can also be a 2D array, one portfolio per row, then arrays 
+        # of properties are returned (one matrix product for all rows) and 
+        # the weights and properties are not overwritten
         
         if self.get_returns_lastUpdated() is None:
             raise Exception('Returns have never been updated.  You need returns to calculate the properties.')
+
+        batch = np.ndim(weights) == 2
         
         if annualize is None:
             # use default or preset (if not this, then use what was passed, no action needed)
@@ -594,9 +1023,18 @@ class Portfolio:
             else:
                 # we had a preset use that
                 annualize = self.annualize
-        if update:
-            # set whatever value is used for the future 
+
+        if update and not batch:
+            # set whatever value is used for the future, the properties
+            # come from the graph (recalculated only if something changed)
             self.annualize =annualize
+            if weights is not None:
+                # assumes weights passed are ligit and use those
+                self.set_weights(weights)
+            else:
+                # the current weights may have been edited in place
+                self._weights.set(self._weights.get())
+            return self.expectedReturn, self.returnDispersion
 
         # to get this far a time frame would have been set
         if annualize:
@@ -605,42 +1043,75 @@ class Portfolio:
             annualizeBy = 'None'
 
 
-        # update the weights if passed
         if weights is None:
             weights = self.weights
-        else:
-            # assumes weights passed are ligit and use those
-            if update:
-                self.set_weights(weights)
 
         
         expectedReturn, returnDispersion = gf.asset_set_perform(weights, 
                 self.expectedReturnArray, self.returnCoDispersionSqMatrix, 
                 annualizeBy=annualizeBy)
 
-        if update:
-            self.expectedReturn = expectedReturn
-            self.returnDispersion = returnDispersion
-
         return expectedReturn, returnDispersion
 
     def get_syms(self):
-        if type(self.assets[0]) is str:
-            # only reasonable choice is this is the symbol list
-            syms = assets
-        else:
-            # assuming it is an asset list
-            syms = []
-            for asset in self.assets:
-                syms.append(asset.sym)
+        # symbols in the order of the weights
+        return list(self.assetSet.syms)
 
-        return syms
+    def save_snapshot(self, path):
+        # write the prices, weights, parameters and, if set, the returns 
+        # and asset statistics to a binary snapshot file 
+        # (see data_mining/snapshot.py and restore_snapshot)
+        if self.get_prices_lastUpdated() is None:
+            raise Exception('Prices have never been updated, there is nothing to snapshot.')
+        arrays = {'dates': self.prices.times, 'prices': self.prices.values, 
+                'weights': np.asarray(self.weights, dtype=float)}
+        params = {'kind': 'Portfolio', 'syms': [str(sym) for sym in self.get_syms()], 
+                'priceName': self.prices.name, 
+                'pricesLastUpdated': self.prices.lastUpdated.isoformat(), 
+                'annualize': None if self.annualize is None else bool(self.annualize)}
+        if self._returnParams.get() is not None:
+            _returns2snapshot(self.returns, arrays, params)
+            arrays['expectedReturnArray'] = self.expectedReturnArray
+            _codisp2snapshot(self.returnCoDispersionSqMatrix, arrays)
+
+        snapshot.write_snapshot(path, arrays, params)
+
+    @classmethod
+    def restore_snapshot(cls, path, priceLoader=None):
+        # a Portfolio from a snapshot file (see save_snapshot) ready to 
+        # optimize, nothing is recalculated and the arrays are memory 
+        # mapped (read only) so only the data used is read from disk.
+        # A priceLoader can be passed for later price updates
+        arrays, params = snapshot.read_snapshot(path)
+        if params.get('kind') != 'Portfolio':
+            raise Exception('The snapshot '+str(path)+' is not of a Portfolio.')
+        assetSet = AssetSet(params['syms'], arrays['dates'], arrays['prices'], 
+                name=params['priceName'], priceLoader=priceLoader)
+        assetSet.lastUpdated = datetime.datetime.fromisoformat(params['pricesLastUpdated'])
+        portfolio = cls(assetSet, arrays['weights'], priceLoader=priceLoader)
+        portfolio.annualize = params['annualize']
+
+        if 'returns' in params:
+            # set the return params, then put the stored results in 
+            # the graph as if they were just calculated
+            info = params['returns']
+            portfolio.update_returns(timeFrame=info['timeFrame'], metric=info['metric'], 
+                    method=info['method'], sampInt=info['sampInt'], 
+                    nFactors=info['nFactors'], calendar=info['calendar'], 
+                    ensemble=info['ensemble'])
+            portfolio._returns.restore(_snapshot2returns(arrays, params))
+            portfolio._expectedReturnArray.restore(arrays['expectedReturnArray'])
+            portfolio._returnCoDispersionSqMatrix.restore(_snapshot2codisp(arrays))
+
+        return portfolio
 
     def calc_sharpe_ratio(self,riskFreeRate=0, weights=None, annualize=None):
         # we caculate and return the Sharpe Ratio (see genFin.py for info) of this portfolio.
         # we allow the user to explore different weights by passing them
         # the user can also turn the annualize off or on if passed
         # in this case nothing is overwritten 
+        # weights can be 2D (one portfolio per row) and riskFreeRate an 
+        # array to sweep rates, see genFin.asset_set_sharpe_ratio
 
         if self.get_returns_lastUpdated() is None:
             raise Exception('No returns set for this portfolio.  You must first update returns.')
@@ -671,14 +1142,28 @@ class Portfolio:
 
         return sr
 
-    def optimal(self, target='Sharpe Ratio', riskFreeRate=0, annualize=None):
+    @profiling.profiled('Portfolio.optimal', shapeOf=_portfolio_shape)
+    def optimal(self, target='Sharpe Ratio', riskFreeRate=0, annualize=None, solver='SLSQP',
+            constraintSet=(0, 1)):
         # Finds the optimal weights of this portfolio for target  
         # options include 
         # Shapre Ratio - mazimize its sharpe ratio (default)
         # Dispersion - minimize its dispersion 
+        # HRP - hierarchical risk parity allocation (see portOpt.hrp_weights), 
+        #   no solver so it works for universes too large to optimize, 
+        #   long only and the solver setting is not used
+        # The solver can be 
+        # SLSQP - scipy's general optimizer (default)
+        # QP - the convex QP reformulation in portOpt (long only weights),
+        #   faster and free of poor local solutions for larger portfolios
+        # constraintSet - (min, max) bounds for each weight
         # Does not override anything, old wieghts will still be inplace
         # if you want to optimize this portfolio in full use optimize
         # returns the weights
+        # Solutions are memoized, EF, CAL and Plotter ask for the same ones 
+        # several times, the memo belongs to the versions of the asset 
+        # statistics nodes, it is dropped once either is recomputed 
+        # (new prices or return params), new weights leave it in place
         if self.get_returns_lastUpdated() is None:
             raise Exception('No returns set for this portfolio.  You must first update returns.')
 
@@ -696,14 +1181,39 @@ class Portfolio:
             else:
                 annualizeBy = 'None'
         
+        if solver == 'SLSQP':
+            maxSharpeRatio = po.max_sharpe_ratio
+            minDispersion = po.min_dispersion
+        elif solver == 'QP':
+            maxSharpeRatio = po.max_sharpe_ratio_qp
+            minDispersion = po.min_dispersion_qp
+        else:
+            raise Exception('Solver for optimization not known: '+solver)
+
+        # the min dispersion does not depend on the risk free rate
+        memoRiskFreeRate = riskFreeRate if target == 'Sharpe Ratio' else None
+        # bring the statistics up to date before reading their versions
+        rExps = self.expectedReturnArray
+        rCoDispSq = self.returnCoDispersionSqMatrix
+        statsVersion = (self._expectedReturnArray.version, 
+                self._returnCoDispersionSqMatrix.version)
+        if statsVersion != self._optimalMemoVersion:
+            self._optimalMemo = {}
+            self._optimalMemoVersion = statsVersion
+        key = (target, memoRiskFreeRate, annualizeBy, tuple(constraintSet), solver)
+        if key in self._optimalMemo:
+            # a copy so the caller cannot change the memo
+            return self._optimalMemo[key].copy()
+
         # run existing optimizer
         if target == 'Sharpe Ratio':
-            optResults = po.max_sharpe_ratio(self.expectedReturnArray, 
-                    self.returnCoDispersionSqMatrix, riskFreeRate=riskFreeRate,
-                    annualizeBy=annualizeBy)
+            optResults = maxSharpeRatio(rExps, rCoDispSq, riskFreeRate=riskFreeRate,
+                    constraintSet=constraintSet, annualizeBy=annualizeBy)
         elif target == 'Dispersion':
-            optResults = po.min_dispersion(self.expectedReturnArray, 
-                    self.returnCoDispersionSqMatrix,
+            optResults = minDispersion(rExps, rCoDispSq, constraintSet=constraintSet,
+                    annualizeBy=annualizeBy)
+        elif target == 'HRP':
+            optResults = po.hrp_weights(rExps, rCoDispSq, constraintSet=constraintSet,
                     annualizeBy=annualizeBy)
         else:
             raise Exception('Target set for optimization not known: '+target)
@@ -711,6 +1221,7 @@ class Portfolio:
         
         # get the weights
         wOpt = optResults['x']
+        self._optimalMemo[key] = wOpt.copy()
 
         return wOpt
 
@@ -718,7 +1229,8 @@ class Portfolio:
 
 
 
-    def optimize(self, target='Sharpe Ratio', riskFreeRate=0, annualize=None):
+    def optimize(self, target='Sharpe Ratio', riskFreeRate=0, annualize=None, solver='SLSQP',
+            constraintSet=(0, 1)):
         # Find the optimal weights of this portfolio for target  
         # options include 
         # Shapre Ratio - mazimize its sharpe ratio (default)
@@ -727,7 +1239,8 @@ class Portfolio:
         # returns the expected return and return dispersion for the portfolio
 
         # This calculates and sets (overrides) portfolio properties
-        wOpt = self.optimal(target=target, riskFreeRate=riskFreeRate, annualize=annualize)
+        wOpt = self.optimal(target=target, riskFreeRate=riskFreeRate, annualize=annualize,
+                solver=solver, constraintSet=constraintSet)
         expectedReturn, returnDispersion = self.calc_properties(weights=wOpt, 
                 annualize=annualize)
 
@@ -16,6 +16,7 @@ from functions import genStats as gs
 from functions import genFin as gf
 from functions import utils
 from functions import portOpt as po
+from functions import profiling
 
 from classes import CondorCoreObs as Condor
 
@@ -28,6 +29,13 @@ import plotly.graph_objects as go
 # a small number that could be considered zero compared to 1.0
 eps = 1e-7
 
+# data sizes recorded when profiling (see functions/profiling.py)
+def _curve_shape(self, portfolio, *args, **kwargs):
+    return np.shape(portfolio.prices.values)
+
+def _plotter_shape(self, *args, **kwargs):
+    return np.shape(self.portfolio.prices.values)
+
 # originally we planned to allow for curves to be created for any set of assets
 # however, we decided to force the use of a portfolio set only for now
 # there are many precalculated things in a portfolio so this way we dont have to redo 
@@ -40,7 +48,30 @@ eps = 1e-7
 # features in the Portfolio object.
 
 class EF:
-    def __init__(self,portfolio,riskFreeRate=0,annualize=None, returnRange=None):
+    @profiling.profiled('EF', shapeOf=_curve_shape)
+    def __init__(self,portfolio,riskFreeRate=0,annualize=None, returnRange=None,
+            warmStart=False, nProc=1, engine='SLSQP', adaptive=False, nInit=21,
+            maxPoints=101, weightTol=0.05, curveTol=0.02, solver='SLSQP'):
+    # engine - how the frontier weights are found
+    #   SLSQP (default) one min dispersion solve per target return
+    #   CLA the corner portfolios are found with the critical line algorithm
+    #       and the weights interpolated exactly between them (see portOpt)
+    #       the corners are kept as cornerWeights
+    # warmStart and nProc are passed to portOpt.calc_efficient_frontier,
+    # start each target from its neighbor's solution and/or solve
+    # contiguous chunks of targets in parallel processes (SLSQP only)
+    # adaptive - (SLSQP only) start from nInit evenly spaced targets and 
+    #   add targets between neighbors whose weights (weightTol) or curve 
+    #   direction (curveTol) change too much, up to maxPoints in total 
+    #   (see portOpt.refine_efficient_frontier), so the solves go to the 
+    #   bend near the min dispersion portfolio rather than the flat part
+    #   otherwise 101 evenly spaced targets are solved
+    # solver - passed to portfolio.optimal for the min dispersion end of 
+    #   the default return range (shared with other curves through its memo)
+    # the points are kept in order of return and can be queried by 
+    # interpolation without solving again, see weights_at_return,
+    # dispersion_at_return and return_at_dispersion
+    #
     # we are forcing a portfolio object, with calculated returns, be passed
     # we wanted to make it more general but forcing a portfolio lets us 
     # use the portfolio methods already writen and forcing returns to exist
@@ -66,47 +97,112 @@ class EF:
         else:
             annualizeBy = 'None'
 
+        if engine == 'CLA':
+            cornerWeights, _ = po.calc_cla_corners(portfolio.expectedReturnArray,
+                    portfolio.returnCoDispersionSqMatrix)
+            if returnRange is None:
+                # the corners span exactly from max return to min dispersion
+                cornerReturns = cornerWeights @ portfolio.expectedReturnArray
+                cornerReturns = cornerReturns * gf.annualize_factor(annualizeBy)
+                returnRange = (min(cornerReturns), max(cornerReturns))
+            self.cornerWeights = cornerWeights
+        elif engine != 'SLSQP':
+            raise Exception('Efficient frontier engine not known: '+engine)
+
         if returnRange is None:
             # get the minimum as min risk and max as single asset max
             # get the min dispersion weights
             wOpt = portfolio.optimal(target='Dispersion', riskFreeRate=riskFreeRate, 
-                    annualize=annualize)
+                    annualize=annualize, solver=solver)
             expectedReturn_minDisp, returnDispersion_minDisp = portfolio.calc_properties(weights=wOpt, 
                     annualize=annualize, update=False)
 
             returns = portfolio.expectedReturnArray
             dispersions = np.sqrt(np.diag(portfolio.returnCoDispersionSqMatrix))
-        if annualize:
-            returns, dispersions = gf.annualize(returns,dispersions,portfolio.timeFrame)
+            if annualize:
+                returns, dispersions = gf.annualize(returns,dispersions,portfolio.timeFrame)
 
             returnRange = (expectedReturn_minDisp, max(returns))
 
-        returnTargets = np.linspace(returnRange[0], returnRange[1], 101)
+        if adaptive and engine == 'SLSQP':
+            returnTargets = np.linspace(returnRange[0], returnRange[1], nInit)
+        else:
+            returnTargets = np.linspace(returnRange[0], returnRange[1], 101)
 
         self.annualize=annualize
         self.riskFreeRate=riskFreeRate
         
 
         # calculate the frontier weights 
-        wEF = po.calc_efficient_frontier(portfolio.expectedReturnArray, 
-                portfolio.returnCoDispersionSqMatrix, returnTargets, 
-                riskFreeRate=riskFreeRate, annualizeBy=annualizeBy)
+        if engine == 'CLA':
+            wEF, converged = po.calc_efficient_frontier_cla(portfolio.expectedReturnArray,
+                    portfolio.returnCoDispersionSqMatrix, returnTargets,
+                    riskFreeRate=riskFreeRate, annualizeBy=annualizeBy,
+                    returnStatus=True, cornerWeights=cornerWeights)
+        else:
+            wEF, converged = po.calc_efficient_frontier(portfolio.expectedReturnArray,
+                    portfolio.returnCoDispersionSqMatrix, returnTargets,
+                    riskFreeRate=riskFreeRate, annualizeBy=annualizeBy,
+                    warmStart=warmStart, nProc=nProc, returnStatus=True)
+            if adaptive:
+                returnTargets, wEF, converged = po.refine_efficient_frontier(
+                        portfolio.expectedReturnArray, portfolio.returnCoDispersionSqMatrix,
+                        returnTargets, wEF, converged, annualizeBy=annualizeBy,
+                        weightTol=weightTol, curveTol=curveTol, maxPoints=maxPoints)
+
+        # failed solves are kept (the properties are recalculated below)
+        # but we flag them so they are not silently trusted
+        if not np.all(converged):
+            print('Warning: '+str(np.sum(~converged))+' of '+str(len(converged))+
+                    ' efficient frontier targets did not converge, see EF.converged.')
 
         # calculate the properties for each wighting 
         # optimization is not exact so while the target return was set as a goal
 # it may not have been achived, need to recalculate 
-        n = len(wEF)
-        returnExps_EF = np.zeros(n) * np.nan
-        returnDisps_EF = np.zeros(n) * np.nan
-
-        for i in range(n):
-            returnExps_EF[i], returnDisps_EF[i] = gf.asset_set_perform(wEF[i], 
-                    portfolio.expectedReturnArray, portfolio.returnCoDispersionSqMatrix, 
-                    annualizeBy=annualizeBy)
+        # (all rows at once)
+        returnExps_EF, returnDisps_EF = gf.asset_set_perform(wEF, 
+                portfolio.expectedReturnArray, portfolio.returnCoDispersionSqMatrix, 
+                annualizeBy=annualizeBy)
 
         self.expectedReturns = returnExps_EF
         self.returnDispersions = returnDisps_EF
         self.weights = wEF
+        self.returnTargets = returnTargets
+        self.converged = converged
+
+        # points for the interpolation queries, finite and sorted once 
+        # (solver noise can leave neighbors slightly out of order)
+        ok = np.isfinite(returnExps_EF) & np.isfinite(returnDisps_EF)
+        order = np.argsort(returnExps_EF[ok])
+        self._queryReturns = returnExps_EF[ok][order]
+        self._queryDisps = returnDisps_EF[ok][order]
+        self._queryWeights = wEF[ok][order]
+        self._queryDispOrder = np.argsort(self._queryDisps)
+
+    def weights_at_return(self, r):
+        # frontier weights at expected return(s) r, interpolated between the 
+        # neighboring frontier points (nan outside the frontier)
+        r = np.asarray(r, dtype=float)
+        rets = self._queryReturns
+        i = np.clip(np.searchsorted(rets, r) - 1, 0, len(rets) - 2)
+        frac = (r - rets[i]) / (rets[i+1] - rets[i])
+        frac = frac[..., np.newaxis]
+        w = (1 - frac) * self._queryWeights[i] + frac * self._queryWeights[i+1]
+        w[(r < rets[0]) | (r > rets[-1])] = np.nan
+        return w
+
+    def dispersion_at_return(self, r):
+        # frontier dispersion at expected return(s) r (nan outside the frontier)
+        return np.interp(r, self._queryReturns, self._queryDisps,
+                left=np.nan, right=np.nan)
+
+    def return_at_dispersion(self, d):
+        # frontier expected return at dispersion(s) d, above the min 
+        # dispersion portfolio dispersion rises with return so the 
+        # curve can be read either way (nan outside the frontier)
+        order = self._queryDispOrder
+        return np.interp(d, self._queryDisps[order], self._queryReturns[order],
+                left=np.nan, right=np.nan)
 
 
 
@@ -119,10 +215,12 @@ def calc_CAL(x,sr, riskFreeRate):
     return cal
 
 class CAL:
-    def __init__(self,portfolio,riskFreeRate=0,annualize=None):
+    @profiling.profiled('CAL', shapeOf=_curve_shape)
+    def __init__(self,portfolio,riskFreeRate=0,annualize=None,solver='SLSQP'):
         # Capital Allocation line for portfolio 
         # Stores paired expected returns and return dispersions
         # Stores weights as risk free and stock portfolio pairs
+        # solver is passed to portfolio.optimal for the max sharpe ratio
         # 
 
         if portfolio.get_returns_lastUpdated() is None:
@@ -145,7 +243,7 @@ class CAL:
             annualizeBy = 'None'
 
         wOpt = portfolio.optimal(target='Sharpe Ratio', riskFreeRate=riskFreeRate, 
-                annualize=annualize)
+                annualize=annualize, solver=solver)
 
         sr = portfolio.calc_sharpe_ratio(weights=wOpt, riskFreeRate=riskFreeRate, 
                 annualize=annualize)
@@ -154,15 +252,9 @@ class CAL:
 
         returnDispersions = np.linspace(0, maxDisp, 101)
 
-        expectedReturns = np.zeros(len(returnDispersions)) * np.nan
-        weights = np.zeros((len(returnDispersions),2)) * np.nan
-
-        for i in range(len(returnDispersions)):
-            disp = returnDispersions[i]
-            expectedReturns[i] = calc_CAL(disp,sr,riskFreeRate)
-            wStock = disp / maxDisp
-            weights[i,0] = 1 - wStock
-            weights[i,1] = wStock
+        expectedReturns = calc_CAL(returnDispersions,sr,riskFreeRate)
+        wStock = returnDispersions / maxDisp
+        weights = np.column_stack((1 - wStock, wStock))
 
         self.returnDispersions = returnDispersions
         self.expectedReturns = expectedReturns
@@ -170,8 +262,57 @@ class CAL:
 
 
 
+class Cloud:
+    @profiling.profiled('Cloud', shapeOf=_curve_shape)
+    def __init__(self,portfolio,nSamples=100000,annualize=None,blockSize=10000,
+            concentration=1,seed=None):
+        # Cloud of random long only portfolios for context around the
+        # frontier (and as a sanity check, none should be above it)
+        # Stores the expected returns and return dispersions of all samples,
+        # weights are not kept as they would take nSamples x n memory,
+        # the portfolios are drawn and evaluated in blocks
+        # (see genFin.random_portfolio_blocks)
+
+        if portfolio.get_returns_lastUpdated() is None:
+            raise Exception('Portfolio returns are required to calculate the portfolio cloud, please update returns.')
+
+        # set parameters
+        if annualize is None:
+            if portfolio.annualize is None:
+                annualize = Condor.defaultParams['annualize']
+            else:
+                annualize = portfolio.annualize
+
+        if annualize:
+            annualizeBy = portfolio.timeFrame
+        else:
+            annualizeBy = 'None'
+
+        expectedReturns = np.zeros(nSamples) * np.nan
+        returnDispersions = np.zeros(nSamples) * np.nan
+
+        i = 0
+        for _, r, d in gf.random_portfolio_blocks(portfolio.expectedReturnArray,
+                portfolio.returnCoDispersionSqMatrix, nSamples, blockSize=blockSize,
+                concentration=concentration, annualizeBy=annualizeBy, seed=seed):
+            expectedReturns[i:i+len(r)] = r
+            returnDispersions[i:i+len(r)] = d
+            i += len(r)
+
+        self.annualize = annualize
+        self.expectedReturns = expectedReturns
+        self.returnDispersions = returnDispersions
+
+    def downsample(self, maxPoints=5000):
+        # evenly spaced subset of the samples for plotting,
+        # the samples are random so any stride is a fair subset
+        step = max(1, int(np.ceil(len(self.expectedReturns) / maxPoints)))
+        return self.expectedReturns[::step], self.returnDispersions[::step]
+
+
+
 class Plotter:
-    def __init__(self,portfolio,riskFreeRate=0,annualize=None):
+    def __init__(self,portfolio,riskFreeRate=0,annualize=None,solver='SLSQP'):
 
         if portfolio.metric != 'Relative':
             raise Warning('For creating plot text we are assuming relative returns, but the current return metric is not set to Relative, interpretation may be off.')
@@ -189,7 +330,9 @@ class Plotter:
 
         self.annualize = annualize
         self.riskFreeRate = riskFreeRate
+        self.solver = solver
         self.portfolio = portfolio
+        self.cloud = None
 
         returns = portfolio.expectedReturnArray
         dispersions = np.sqrt(np.diag(portfolio.returnCoDispersionSqMatrix))
@@ -201,11 +344,23 @@ class Plotter:
         self.dispersions_assets = dispersions
 
 
-    def get_curves(self):
-        self.ef = EF(self.portfolio,riskFreeRate=self.riskFreeRate,annualize=self.annualize)
-        self.cal = CAL(self.portfolio,riskFreeRate=self.riskFreeRate,annualize=self.annualize)
+    @profiling.profiled('Plotter.get_curves', shapeOf=_plotter_shape)
+    def get_curves(self, nCloud=0, seed=None):
+        # nCloud - number of random portfolios for the background cloud,
+        # zero (default) for no cloud
+        self.ef = EF(self.portfolio,riskFreeRate=self.riskFreeRate,annualize=self.annualize,
+                solver=self.solver)
+        self.cal = CAL(self.portfolio,riskFreeRate=self.riskFreeRate,annualize=self.annualize,
+                solver=self.solver)
+        self.cloud = None
+        if nCloud > 0:
+            self.cloud = Cloud(self.portfolio,nSamples=nCloud,annualize=self.annualize,
+                    seed=seed)
 
-    def plot(self, width=675, height=545): 
+    @profiling.profiled('Plotter.plot', shapeOf=_plotter_shape)
+    def plot(self, width=675, height=545, maxCloudPoints=5000): 
+        # maxCloudPoints - max random portfolios drawn if there is a cloud,
+        # the browser cannot take millions of markers, WebGL takes thousands
 
 
         # Assets
@@ -283,16 +438,10 @@ class Plotter:
         # recall, these are a portion of the sharpe ratio portfolio
 
         wSR = portfolio.optimal(target='Sharpe Ratio', riskFreeRate=self.riskFreeRate, 
-                annualize=self.annualize)
+                annualize=self.annualize, solver=self.solver)
 
-        weights_CAL_exp = np.zeros((len(weights_CAL),len(wSR)+1)) * np.nan
-
-                
-        for i in range(len(weights_CAL)):
-            weights_CAL_exp[i,0] = weights_CAL[i,0] # risk free asset weight
-            tmp = weights_CAL[i,1] # stock portfolio weight
-            for j in range(len(wSR)):
-                weights_CAL_exp[i,j+1] = wSR[j] * tmp
+        # risk free asset weight, then the stock portfolio weight spread over wSR
+        weights_CAL_exp = np.column_stack((weights_CAL[:,0], np.outer(weights_CAL[:,1], wSR)))
 
         weights_CAL_exp = np.round(weights_CAL_exp, 2)
 
@@ -366,7 +515,7 @@ class Plotter:
 
         # Min Dispersion
         wDisp = portfolio.optimal(target='Dispersion', riskFreeRate=self.riskFreeRate, 
-                annualize=self.annualize)
+                annualize=self.annualize, solver=self.solver)
 
         return_Disp, dispersion_Disp = portfolio.calc_properties(weights=wDisp, 
                 annualize=self.annualize, update=False)
@@ -394,6 +543,23 @@ class Plotter:
 
         data = [assetPoints, efPoints, calPoints, rfPoint, msrPoint, mdispPoint]
 
+        # Random portfolio cloud, drawn first so it sits behind the curves
+        if self.cloud is not None:
+            returns_cloud, dispersions_cloud = self.cloud.downsample(maxCloudPoints)
+            cloudPoints = go.Scattergl(
+                    name = 'Random Portfolios',
+                    mode = 'markers',
+                    x = np.round(dispersions_cloud * 100, 2),
+                    y = np.round(returns_cloud * 100, 2),
+                    marker = dict(
+                        color='lightgray',
+                        size=3,
+                        opacity=0.5
+                        ),
+                    hoverinfo = 'skip'
+                    )
+            data.insert(0, cloudPoints)
+
         annualizeText = ''
         if self.annualize: 
             annualizeText = 'Annualized '
@@ -402,6 +568,10 @@ class Plotter:
                 annualizeText = 'Monthly '
             elif portfolio.timeFrame == 'D':
                 annualizeText = 'Daily '
+            elif portfolio.timeFrame == 'W':
+                annualizeText = 'Weekly '
+            elif portfolio.timeFrame == 'Q':
+                annualizeText = 'Quarterly '
 
 
 
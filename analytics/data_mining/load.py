@@ -4,6 +4,13 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+try:
+    from functions.profiling import profiled
+except ImportError:
+    # used outside of analytics (e.g. run from data_mining), no profiling
+    def profiled(name=None, shapeOf=None):
+        return lambda func: func
+
 
 def assetHist_CSV(path, dateH='Date', priceH='Adj Close**',
         sep=',', disp=True, verb=True, assetN='Asset', sortByDate=True):
@@ -46,6 +53,7 @@ def assetHist_CSV(path, dateH='Date', priceH='Adj Close**',
     return data[dateH].to_numpy(), data[priceH].to_numpy()
 
 
+@profiled('load.multiAssetHist_CSV')
 def multiAssetHist_CSV(path, dateH='Date', priceH='Adj Close', 
         symH='Symbol', sep=',', verb=True):
     """Load a simple flat file for historical data of multiple assets.
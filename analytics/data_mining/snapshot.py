@@ -0,0 +1,99 @@
+# Binary snapshots of analytical state (see CondorCoreObs
+# Portfolio.save_snapshot and Asset.save_snapshot).
+#
+# A snapshot is one file:
+#   8 bytes     magic, b'CONDSNAP'
+#   8 bytes     header length in bytes, little endian uint64
+#   header      JSON, the parameters and for each array its dtype,
+#               shape and offset
+#   data        the raw arrays (C order), each starting on a 64 byte
+#               boundary counted from the start of the data
+# On read the arrays are memory mapped, so a restore only reads the
+# header and the pages of data that are actually used.
+
+import json
+import numpy as np
+
+
+MAGIC = b'CONDSNAP'
+VERSION = 1
+ALIGN = 64
+
+
+def _aligned(n):
+    # next multiple of ALIGN
+    return -(-n // ALIGN) * ALIGN
+
+
+def write_snapshot(path, arrays, params=None):
+    """Write arrays and parameters to a binary snapshot file.
+    :param path:    path to file
+    :param arrays:  dict, name to numpy array, numeric, bool or
+                    datetime64 (no object or str arrays, put
+                    small str lists in params)
+    :param params:  dict, JSON serializable parameters
+    """
+    if params is None:
+        params = {}
+
+    specs = {}
+    offset = 0
+    contig = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        if array.dtype.hasobject or array.dtype.kind in 'SUV':
+            raise Exception('Array '+name+' can not be written to a snapshot, dtype '+str(array.dtype)+'.')
+        offset = _aligned(offset)
+        specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                'offset': offset}
+        contig[name] = array
+        offset += array.nbytes
+
+    header = json.dumps({'version': VERSION, 'params': params,
+        'arrays': specs}).encode('utf-8')
+    dataStart = _aligned(len(MAGIC) + 8 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array(len(header), dtype='<u8').tobytes())
+        f.write(header)
+        for name, array in contig.items():
+            f.seek(dataStart + specs[name]['offset'])
+            f.write(array.tobytes())
+        # make sure the file covers the last (possibly empty) array
+        f.truncate(dataStart + offset)
+
+
+def read_snapshot(path, mmap=True):
+    """Read a snapshot file written by write_snapshot.
+    :param path:    path to file
+    :param mmap:    memory map the arrays (read only) if true,
+                    otherwise read them into memory
+    :return arrays: dict, name to numpy array
+    :return params: dict, the parameters
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception('The file '+str(path)+' is not a snapshot.')
+        headerLen = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(headerLen).decode('utf-8'))
+    if header['version'] != VERSION:
+        raise Exception('Snapshot version '+str(header['version'])+' is not supported.')
+    dataStart = _aligned(len(MAGIC) + 8 + headerLen)
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        offset = dataStart + spec['offset']
+        if int(np.prod(shape)) == 0:
+            # nothing to map
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                    shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)),
+                    offset=offset).reshape(shape)
+
+    return arrays, header['params']
@@ -0,0 +1,220 @@
+# Synthetic market data for load and scale testing.
+#
+# Daily prices are simulated as geometric Brownian motion driven by a few
+# common factors plus asset specific noise, both with Student-t (fat
+# tailed) innovations. Some symbols are listed late (e.g. an IPO like
+# ABNB) and have no data before their listing day.
+#
+# The common factor paths are simulated once, the symbols are then
+# simulated and written in blocks, so files far larger than memory can be
+# written (memory is about days x blockSyms values). The outputs are:
+# - the long Symbol,Date,Adj Close CSV that CondorCoreObs.PriceLoader
+#   (load.multiAssetHist_CSV) reads
+# - the polygon daily aggregates JSON list that fetch_aggregates saves
+#   (v, vw, o, c, h, l, t, n plus ticker_id, date and name per record)
+#
+# Usage:
+#   python synthetic.py --syms 500 --days 5000 --csv prices.csv --json aggs.json
+#
+# There is no warranty or guarantee of any kind
+
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+daysPerYear = 252
+
+
+def simulate_blocks(nSyms, nDays, start='2000-01-03', nFactors=3, df=4,
+        annualDrift=0.07, annualVol=0.25, factorShare=0.4, lateListFrac=0.2,
+        blockSyms=256, seed=0):
+    """Simulate daily prices, yielding blocks of symbols.
+
+    :param nSyms:   int, number of symbols
+    :param nDays:   int, number of business days
+    :param start:   str, first date
+    :param nFactors:    int, number of common factors
+    :param df:  float, degrees of freedom of the Student-t innovations
+                (> 2, lower is fatter tailed)
+    :param annualDrift: float, mean annual drift of the symbols
+    :param annualVol:   float, median annual volatility of the symbols
+    :param factorShare: float, fraction of the return variance from the
+                        common factors (sets the correlation)
+    :param lateListFrac:    float, fraction of symbols listed after the
+                            first day
+    :param blockSyms:   int, symbols per block
+    :param seed:    int, random seed
+    :return:    generator of (syms, dates, prices) with syms a str array,
+                dates a datetime64 array (same for all blocks) and prices
+                a float array 2D (dates x syms), nan before listing
+    """
+    if df <= 2:
+        raise Exception('The Student-t degrees of freedom must be above 2 for a finite variance.')
+    dates = pd.bdate_range(start, periods=nDays).to_numpy()
+    # unit variance t innovations
+    tScale = np.sqrt((df - 2) / df)
+
+    rng = np.random.default_rng([seed, 0])
+    factors = rng.standard_t(df, size=(nDays, nFactors)) * tScale
+
+    for b, first in enumerate(range(0, nSyms, blockSyms)):
+        n = min(blockSyms, nSyms - first)
+        rng = np.random.default_rng([seed, b + 1])
+        syms = np.array(['SYN%05d' % i for i in range(first, first + n)])
+
+        # per symbol drift, volatility and unit norm factor loadings,
+        # the first factor is the market, every symbol moves with it
+        drift = rng.normal(annualDrift, 0.05, n) / daysPerYear
+        vol = annualVol * rng.lognormal(0, 0.3, n) / np.sqrt(daysPerYear)
+        loadings = rng.normal(size=(n, nFactors))
+        loadings[:, 0] = np.abs(loadings[:, 0]) + 1
+        loadings /= np.linalg.norm(loadings, axis=1, keepdims=True)
+
+        z = np.sqrt(factorShare) * (factors @ loadings.T)
+        z += np.sqrt(1 - factorShare) * rng.standard_t(df, size=(nDays, n)) * tScale
+        logReturns = drift - vol**2 / 2 + vol * z
+
+        # listing day, the late ones anywhere up to 90% of the way in
+        listing = np.zeros(n, dtype=int)
+        late = rng.random(n) < lateListFrac
+        listing[late] = rng.integers(1, max(2, int(nDays * 0.9)), np.sum(late))
+        listed = np.arange(nDays)[:, np.newaxis] >= listing
+
+        # price path from the listing day, no return on the listing day
+        logReturns[~listed] = 0
+        logReturns[listing, np.arange(n)] = 0
+        prices = rng.lognormal(np.log(50), 0.8, n) * np.exp(np.cumsum(logReturns, axis=0))
+        prices[~listed] = np.nan
+
+        yield syms, dates, prices
+
+
+def simulate_prices(nSyms, nDays, **simParams):
+    """All simulated prices in memory (see simulate_blocks for the
+    parameters), for universes that fit.
+
+    :return prices: float array 2D, dates x syms, nan before listing
+    :return dates:  datetime64 array
+    :return syms:   str array
+    """
+    blocks = list(simulate_blocks(nSyms, nDays, **simParams))
+    prices = np.hstack([block[2] for block in blocks])
+    syms = np.concatenate([block[0] for block in blocks])
+    return prices, blocks[0][1], syms
+
+
+def write_prices_csv(path, nSyms, nDays, dateH='Date', priceH='Adj Close',
+        symH='Symbol', sep=',', **simParams):
+    """Stream simulated prices to a long format CSV (one row per symbol
+    and listed date) as read by load.multiAssetHist_CSV.
+
+    :param path:    str, output file
+    :param nSyms:   int, number of symbols
+    :param nDays:   int, number of business days
+    :param dateH:   str, date header
+    :param priceH:  str, price header
+    :param symH:    str, symbol header
+    :param sep: str, seperation char
+    :param simParams:   see simulate_blocks
+    :return:    int, number of rows written
+    """
+    nRows = 0
+    with open(path, 'w', newline='') as f:
+        f.write(sep.join([symH, dateH, priceH]) + '\n')
+        dateStrs = None
+        for syms, dates, prices in simulate_blocks(nSyms, nDays, **simParams):
+            if dateStrs is None:
+                dateStrs = pd.DatetimeIndex(dates).strftime('%Y-%m-%d').to_numpy()
+            # symbol major, one symbol's dates in order
+            j, t = np.nonzero(~np.isnan(prices.T))
+            block = pd.DataFrame({symH: syms[j], dateH: dateStrs[t], priceH: prices[t, j]})
+            block.to_csv(f, header=False, index=False, sep=sep, float_format='%.6f')
+            nRows += len(block)
+    return nRows
+
+
+# one polygon daily aggregate record, fields as saved by fetch_aggregates
+_aggTemplate = ('{"v": %.1f, "vw": %.4f, "o": %.4f, "c": %.4f, "h": %.4f, "l": %.4f, '
+        '"t": %d, "n": %d, "ticker_id": %d, "date": "%s", "name": "%s"}')
+
+def write_aggregates_json(path, nSyms, nDays, **simParams):
+    """Stream simulated daily aggregates to a JSON list in the format
+    fetch_aggregates.save_fetched_data writes (records per ticker, in
+    date order). The close (c) is the simulated price, the open, high,
+    low, volume weighted price, volume and number of trades are drawn
+    around it.
+
+    :param path:    str, output file
+    :param nSyms:   int, number of symbols
+    :param nDays:   int, number of business days
+    :param simParams:   see simulate_blocks
+    :return:    int, number of records written
+    """
+    nRecords = 0
+    seed = simParams.get('seed', 0)
+    with open(path, 'w') as f:
+        f.write('[')
+        stamps = None
+        for b, (syms, dates, prices) in enumerate(simulate_blocks(nSyms, nDays, **simParams)):
+            if stamps is None:
+                # polygon stamps a day at its start in New York, in ms
+                days = pd.DatetimeIndex(dates).tz_localize('America/New_York')
+                stamps = days.asi8 // 10**6
+                dateStrs = days.tz_convert('UTC').strftime('%Y-%m-%d %H:%M:%S').to_numpy()
+            rng = np.random.default_rng([seed, b + 1, 1])
+            close = prices
+            prevClose = np.vstack((close[:1], close[:-1]))
+            prevClose = np.where(np.isnan(prevClose), close, prevClose)
+            shape = close.shape
+            opn = prevClose * np.exp(rng.normal(0, 0.005, shape))
+            high = np.maximum(opn, close) * (1 + np.abs(rng.normal(0, 0.01, shape)))
+            low = np.minimum(opn, close) * (1 - np.abs(rng.normal(0, 0.01, shape)))
+            vw = low + (high - low) * rng.uniform(0.3, 0.7, shape)
+            volume = np.round(rng.lognormal(13, 1, shape))
+            trades = np.maximum(1, (volume / rng.uniform(50, 200, shape)).astype(int))
+
+            first = b * simParams.get('blockSyms', 256)
+            for j in range(len(syms)):
+                rows = np.where(~np.isnan(close[:, j]))[0]
+                parts = [_aggTemplate % (volume[t, j], vw[t, j], opn[t, j], close[t, j],
+                    high[t, j], low[t, j], stamps[t], trades[t, j], first + j,
+                    dateStrs[t], syms[j]) for t in rows]
+                if not parts:
+                    continue
+                f.write((', ' if nRecords > 0 else '') + ', '.join(parts))
+                nRecords += len(parts)
+        f.write(']')
+    return nRecords
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write synthetic market data files.')
+    parser.add_argument('--syms', type=int, default=100, help='number of symbols')
+    parser.add_argument('--days', type=int, default=2520, help='number of business days')
+    parser.add_argument('--start', default='2000-01-03')
+    parser.add_argument('--csv', default=None, help='long Symbol,Date,Adj Close CSV output')
+    parser.add_argument('--json', default=None, help='polygon aggregates JSON output')
+    parser.add_argument('--df', type=float, default=4, help='Student-t degrees of freedom')
+    parser.add_argument('--late', type=float, default=0.2, help='fraction of late listings')
+    parser.add_argument('--block', type=int, default=256, help='symbols per block')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.csv is None and args.json is None:
+        parser.error('Nothing to write, pass --csv and/or --json.')
+    simParams = {'start': args.start, 'df': args.df, 'lateListFrac': args.late,
+            'blockSyms': args.block, 'seed': args.seed}
+    if args.csv is not None:
+        n = write_prices_csv(args.csv, args.syms, args.days, **simParams)
+        print('Wrote '+str(n)+' rows to '+args.csv)
+    if args.json is not None:
+        n = write_aggregates_json(args.json, args.syms, args.days, **simParams)
+        print('Wrote '+str(n)+' records to '+args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
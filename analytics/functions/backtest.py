@@ -0,0 +1,137 @@
+# This module contains a vectorized portfolio backtest.
+# Given a price matrix and a schedule of weights set at rebalance dates
+# (for example Portfolio.optimal results or the weight history of
+# walkForward.walk_forward, rebalanced at its window ends) it realizes
+# the portfolio value path.
+#
+# Between rebalances the holdings are fixed so the weights drift with
+# the prices, the value path of a segment is one matrix product of the
+# price relatives since the rebalance and the weights. Many weight
+# schedules (strategies) over the same prices and rebalance dates are
+# evaluated in the same matrix products.
+#
+# Transaction costs are proportional to the traded value, turnover at a
+# rebalance is the sum of absolute differences between the new weights
+# and the drifted weights from the previous segment.
+#
+# There is no warranty or guarantee of any kind
+
+import numpy as np
+
+
+def backtest(prices, rebalInds, weights, costRate=0, initValue=1):
+    """Realize the value path of weight schedules over a price matrix.
+
+    :param prices:  float array 2D, rows as consecutive dates, cols as
+                    assets (nan where there is no price)
+    :param rebalInds:   int array, increasing price row indices at which
+                        the portfolio is rebalanced to the scheduled weights
+    :param weights: float array, (rebalance x asset) weight schedule or
+                    (strategy x rebalance x asset) for many schedules at
+                    once, weights summing to less than one leave the rest
+                    in cash (no return), an asset with nan prices in a
+                    segment must have zero weight for that segment
+    :param costRate:    float, cost as a fraction of the traded value,
+                        e.g. 0.001 for 10 basis points, the first
+                        allocation is charged as a trade from cash
+    :param initValue:   float, value at the first rebalance (before costs)
+    :return values: float array, value path from the first rebalance row
+                    to the last price row (prices[rebalInds[0]:]), 2D
+                    (strategy x time) if a batch of schedules was passed
+    :return turnover:   float array, turnover at each rebalance, 2D
+                        (strategy x rebalance) for a batch
+    """
+    prices = np.asarray(prices, dtype=float)
+    rebalInds = np.asarray(rebalInds, dtype=int)
+    weights = np.asarray(weights, dtype=float)
+    single = weights.ndim == 2
+    if single:
+        weights = weights[np.newaxis]
+    nStrat, nReb, n = weights.shape
+    nRows = prices.shape[0]
+
+    if len(rebalInds) != nReb:
+        raise Exception('The weight schedule must have one row per rebalance date.')
+    if prices.shape[1] != n:
+        raise Exception('The weight schedule must have one column per asset.')
+    if np.any(np.diff(rebalInds) <= 0) or rebalInds[0] < 0 or rebalInds[-1] >= nRows:
+        raise Exception('Rebalance indices must be increasing price row indices.')
+
+    # segment k runs from rebalance k up to (and including) rebalance k+1,
+    # the last one to the last price row
+    segEnds = np.append(rebalInds[1:], nRows-1)
+    nPath = nRows - rebalInds[0]
+    growth = np.empty((nStrat, nPath))
+    growthEnd = np.empty((nStrat, nReb))
+    turnover = np.empty((nStrat, nReb))
+    cash = 1 - np.sum(weights, axis=2)
+
+    wDrift = np.zeros((nStrat, n))
+    for k in range(nReb):
+        start = rebalInds[k]
+        stop = segEnds[k]
+        rel = prices[start:stop+1] / prices[start]
+        missing = np.isnan(rel)
+        if np.any(missing):
+            held = np.any(weights[:, k] != 0, axis=0)
+            if np.any(missing[:, held]):
+                raise Exception('Non-zero weight on an asset with missing prices between rows '+
+                        str(start)+' and '+str(stop)+'.')
+            rel = np.where(missing, 0, rel)
+
+        # value relative to the rebalance, all strategies in one product
+        g = rel @ weights[:, k].T + cash[:, k]
+        # the segment's last row is the next segment's first, store it once
+        if k < nReb - 1:
+            growth[:, start-rebalInds[0]:stop-rebalInds[0]] = g[:-1].T
+        else:
+            growth[:, start-rebalInds[0]:] = g.T
+        growthEnd[:, k] = g[-1]
+
+        turnover[:, k] = np.sum(np.abs(weights[:, k] - wDrift), axis=1)
+        # weights drifted to the end of this segment
+        wDrift = weights[:, k] * rel[-1] / g[-1][:, np.newaxis]
+
+    # value just after each rebalance (after costs)
+    costFact = 1 - costRate * turnover
+    prevGrowth = np.hstack((np.ones((nStrat, 1)), growthEnd[:, :-1]))
+    startValues = initValue * np.cumprod(prevGrowth * costFact, axis=1)
+
+    seg = np.searchsorted(rebalInds, np.arange(rebalInds[0], nRows), side='right') - 1
+    values = startValues[:, seg] * growth
+
+    if single:
+        return values[0], turnover[0]
+    return values, turnover
+
+
+def calc_backtest_stats(values, periodsPerYear=252):
+    """Summary statistics of value paths from backtest.
+
+    :param values:  float array, value path (or strategy x time paths)
+                    with one row per trading period
+    :param periodsPerYear:  int, periods per year (252 for daily rows)
+    :return totalReturn:    float (array), relative return over the path
+    :return annualReturn:   float (array), compounded annual return,
+                            nan for a path of a single value
+    :return annualDisp: float (array), annualized standard deviation
+                        of the period returns, nan for a path of a
+                        single value
+    :return maxDrawdown:    float (array), largest relative drop from a
+                            running peak (positive number)
+    """
+    values = np.asarray(values, dtype=float)
+    totalReturn = values[..., -1] / values[..., 0] - 1
+    years = (values.shape[-1] - 1) / periodsPerYear
+    if years <= 0:
+        # no periods, nothing to annualize
+        annualReturn = totalReturn * np.nan
+        annualDisp = totalReturn * np.nan
+    else:
+        annualReturn = (1 + totalReturn) ** (1 / years) - 1
+        periodReturns = values[..., 1:] / values[..., :-1] - 1
+        annualDisp = np.std(periodReturns, axis=-1) * np.sqrt(periodsPerYear)
+    peaks = np.maximum.accumulate(values, axis=-1)
+    maxDrawdown = np.max(1 - values / peaks, axis=-1)
+
+    return totalReturn, annualReturn, annualDisp, maxDrawdown
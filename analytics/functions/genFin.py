@@ -40,7 +40,8 @@ def returns(x,period=21,metric='Relative'):
     """Calculate the returns over a set period
     given an array of asset prices, x.
     
-    Assumes all entries in x are consecutive.
+    Assumes all entries in x are consecutive, 
+    see calendar_returns for periods taken from the row times.
 
     :param x:   float array, consecutive prices
     :param period:  int, period for returns,period or 
@@ -55,26 +56,62 @@ def returns(x,period=21,metric='Relative'):
             Log                     log( x_[t=period] / x_0 )
     :return r:  float array, seris of returns using set metric  
     """
+    x = np.asarray(x, dtype=float)
     n = len(x)
 
-    
-    # is this a vector or a matrix?
-    if len(x.shape)==1:
-        r = np.zeros(n-period)
-        # I should remove this loop and use a shifting function
-        # https://stackoverflow.com/questions/62377978/numpy-array-equivalent-of-pandas-shift-function
-        for i in range(0,n-period,1):
-            r[i] = calc_return(x[i],x[i+period],metric=metric)
+    # shifted views of the rows, one vectorized calculation 
+    # for vectors and matrices (cols as assets) alike
+    r = calc_return(x[:n-period], x[period:], metric=metric)
 
-    elif len(x.shape)==2:
-        # just apply the 1D part of this function over all columns
-        # faster and cleaner than looping here
-        def alt_func(a): return(returns(a,period=period,metric=metric))
-        r = np.apply_along_axis(alt_func, 0, x)
+    return r
 
 
+# calendar length of each return time frame (see calendar_returns)
+timeFrameOffsets = {
+        'D': pd.DateOffset(days=1),
+        'W': pd.DateOffset(weeks=1),
+        'M': pd.DateOffset(months=1),
+        'Q': pd.DateOffset(months=3),
+        'Y': pd.DateOffset(years=1)
+        }
+
+def calendar_period_rows(times, timeFrame='M'):
+    """Find for every row the row one calendar period later, that is 
+    the first row at or after its time plus the period, so gaps in 
+    the data and any sampling frequency are handled.
+
+    :param times:   datetime64 array, row times in temporal order
+    :param timeFrame:   str, period 'D', 'W', 'M', 'Q' or 'Y' 
+                        (see timeFrameOffsets)
+    :return ends:   int array, row one period after each row i, 
+                    only for the rows i=0,1,.. that have one 
+    """
+    if timeFrame not in timeFrameOffsets:
+        raise Exception('The time frame '+timeFrame+' is not known.')
+    times = pd.DatetimeIndex(times)
+    targets = times + timeFrameOffsets[timeFrame]
+    ends = np.searchsorted(times.to_numpy(), targets.to_numpy(), side='left')
+    # targets are in order, the rows past the data are at the end
+    return ends[ends < len(times)]
+
+def calendar_returns(x, times, timeFrame='M', metric='Relative'):
+    """Calculate the returns over one calendar period 
+    (see calendar_period_rows) given an array of asset prices, x,
+    in one gather of the start and end rows.
+
+    :param x:   float array, prices (if 2D rows=time, cols=assets)
+    :param times:   datetime64 array, times of the rows of x
+    :param timeFrame:   str, period 'D', 'W', 'M', 'Q' or 'Y'
+    :param metric:  str, what type of return (see returns)
+    :return r:  float array, returns starting at the rows 0,1,.. 
+                that have a row one period later
+    :return ends:   int array, row of x at the end of each return
+    """
+    x = np.asarray(x, dtype=float)
+    ends = calendar_period_rows(times, timeFrame=timeFrame)
+    r = calc_return(x[:len(ends)], x[ends], metric=metric)
 
-    return r
+    return r, ends
 
 
 def returnExp(r, method='Robust'):
@@ -115,7 +152,7 @@ def returnDisp(r, method='Robust'):
     rDisp = np.apply_along_axis(alt_func, 0, r)
     return rDisp
 
-def returnCoDispSq(r,method='Robust'):
+def returnCoDispSq(r,method='Robust',nFactors=None):
     """Calculate the squared co-dispersion of pairs of returns given a
     set of returns,r. For example, using the Normal method simply returns
     the standard covariance matrix.
@@ -125,14 +162,47 @@ def returnCoDispSq(r,method='Robust'):
         Possibilities
             Robust (default)    robsut statistics, sq coMAD normal adjusted 
             Normal              assume normal dist, covariance
-    :return:    float (float array if r is 2D), dispersion value of return set
+    :param nFactors:    int, if set fit a low rank model with nFactors 
+                        factors plus a diagonal instead of the full matrix,
+                        see genStats.fit_factor_codisper_sq, None or 
+                        0 for the full matrix
+    :return:    float (float array if r is 2D), dispersion value of return set,
+                or a genStats.FactorCoDispSq if nFactors is set
     """
     if method=='Robust':
         # currently assuming Co-MAD for robust, other options exist later
         method='CoMAD'
 
+    if nFactors:
+        return genStats.fit_factor_codisper_sq(r, nFactors, method=method)
+
     return genStats.codisper_sq(r,method=method)
 
+def ensemble_return_stats(rPhases, method='Robust'):
+    """Ensemble estimate of the expected returns and the squared 
+    co-dispersion over sets of returns, e.g. every sampling phase of 
+    a return series, each set is estimated (as in returnExp and 
+    returnCoDispSq) in one batched pass and the estimates are averaged.
+
+    :param rPhases: float array 3D, (set, time, asset) returns
+    :param method:  str, Robust (default) or Normal, see returnExp
+    :return rExp:   float array, ensemble expected returns
+    :return rCoDispSq:  float array 2D, ensemble squared co-dispersion
+    :return rExpSpread: float array, standard deviation of the set 
+                        expected returns
+    :return rCoDispSqSpread:    float array 2D, standard deviation of 
+                                the set squared co-dispersions
+    """
+    if method=='Robust':
+        codispMethod = 'CoMAD'
+    else:
+        codispMethod = method
+    rExps = genStats.expected_phases(rPhases, method=method)
+    rCoDispSqs = genStats.codisper_sq_phases(rPhases, method=codispMethod)
+
+    return (np.mean(rExps, axis=0), np.mean(rCoDispSqs, axis=0),
+            np.std(rExps, axis=0), np.std(rCoDispSqs, axis=0))
+
 def calc_return_prop(r,method='Robust'):
     """Calculate the key properties of a set of returns,r.
     This will be the expected value and the measure of 
@@ -195,7 +265,8 @@ def asset_set_perform(w, rExps, rCoDispSq, annualizeBy='None'):
     as the portfolio weights (w) for each asset.
     The returns can be annualized by providing further info to annualizeBy. 
 
-    :param w:   float array, asset weights, sum must equal one
+    :param w:   float array, asset weights, sum must equal one, or 2D 
+                m x n array with one portfolio per row
     :param rExp:    float array, asset expected returns corrisponding to w, 
                     same length as w
     :param rCoDispSq:   float array 2D, estimated co-dispersion squared of 
@@ -210,35 +281,34 @@ def asset_set_perform(w, rExps, rCoDispSq, annualizeBy='None'):
                                                     are in daily returns
                                                     (note 253 trading days 
                                                     in year)
+                                'W'                 Annualize by week
                                 'M'                 Annualize by month, rExps
                                                     are in monthly returns
                                                     (note 21 trading days in
                                                     month on average)
-    :return portReturn: float, expected return of the portfolio 
+                                'Q'                 Annualize by quarter
+    :return portReturn: float, expected return of the portfolio (array of 
+                        m for 2D w)
     :return portDisp:   float, estimated dispersion of portfolio returns, if
                         data is normally distributed the standard estimate is 
                         the standard deviation, in stats common statistical 
                         analysis this is a measure of one type of portfolio 
-                        risk
+                        risk (array of m for 2D w)
     """
 
+    w = np.asarray(w)
 
     # ensure that weights add to one
-    if np.abs(1 - np.sum(w)) > eps:
-        raise Exception('Weights in w do not add to one: '+str(sum(w)))
+    sums = np.sum(w, axis=-1)
+    if np.any(np.abs(1 - sums) > eps):
+        raise Exception('Weights in w do not add to one: '+str(sums))
 
-    if annualizeBy=='None':
-        annFact = 1
-    elif annualizeBy=='M':
-        annFact = 12
-    elif annualizeBy=='D':
-        annFact = 252 # number of open trading days a year
-    else:
-        raise Exception('Unknown way to annualize by '+annualizeBy)
+    annFact = annualize_factor(annualizeBy)
 
-        
-    portReturn = np.sum(rExps * w)
-    portDisp = np.sqrt(np.dot(w.T, np.dot(rCoDispSq, w)))
+    # one product for all rows, the quadratic form is the row wise 
+    # dot of w C and w
+    portReturn = w @ rExps
+    portDisp = np.sqrt(np.einsum('...i,...i->...', w @ rCoDispSq, w))
 
     portReturn *= annFact
     portDisp *= np.sqrt(annFact) # double check this error propigation
@@ -255,7 +325,8 @@ def asset_set_sharpe_ratio(w, rExps, rCoDispSq, riskFreeRate=0, annualizeBy='Non
 
     More at: https://www.investopedia.com/terms/s/sharperatio.asp
 
-    :param w:   float array, asset weights, sum must equal one
+    :param w:   float array, asset weights, sum must equal one, or 2D 
+                m x n array with one portfolio per row
     :param rExp:    float array, asset expected returns corrisponding to w, 
                     same length as w
     :param rCoDispSq:   float array 2D, estimated co-dispersion squared of 
@@ -270,15 +341,21 @@ def asset_set_sharpe_ratio(w, rExps, rCoDispSq, riskFreeRate=0, annualizeBy='Non
                                                     are in daily returns
                                                     (note 253 trading days 
                                                     in year)
+                                'W'                 Annualize by week
                                 'M'                 Annualize by month, rExps
                                                     are in monthly returns
                                                     (note 21 trading days in
                                                     month on average)
-    :return:    float, Sharpe Ratio
+                                'Q'                 Annualize by quarter
+    :param riskFreeRate:    float, or float array of rates to evaluate at 
+                            once, broadcast against the portfolios (e.g. 
+                            riskFreeRate[:, np.newaxis] with 2D w gives a 
+                            rate x portfolio array)
+    :return:    float, Sharpe Ratio (array for 2D w or array riskFreeRate)
     """
     rExp, rDisp = asset_set_perform(w, rExps, rCoDispSq, annualizeBy)
 
-    sr = (rExp - riskFreeRate) / rDisp
+    sr = (rExp - np.asarray(riskFreeRate)) / rDisp
     return sr
 
 
@@ -310,10 +387,12 @@ def asset_set_neg_sharpe_ratio(w, rExps, rCoDispSq, riskFreeRate=0, annualizeBy=
                                                     are in daily returns
                                                     (note 253 trading days 
                                                     in year)
+                                'W'                 Annualize by week
                                 'M'                 Annualize by month, rExps
                                                     are in monthly returns
                                                     (note 21 trading days in
                                                     month on average)
+                                'Q'                 Annualize by quarter
     :return:    float, Sharpe Ratio
     """
     sr = asset_set_sharpe_ratio(w, rExps, rCoDispSq, 
@@ -338,24 +417,96 @@ def annualize(rExp,rDisp,annualizeBy):
                                                     are in daily returns
                                                     (note 253 trading days 
                                                     in year)
+                                'W'                 Annualize by week
                                 'M'                 Annualize by month, rExps
                                                     are in monthly returns
                                                     (note 21 trading days in
                                                     month on average)
+                                'Q'                 Annualize by quarter
                                 'Y'                 Annualize by year, same as None
     :return:    float (array if array passed), 
                 annualized expected and dispersion values
     """
 
+    annFact = annualize_factor(annualizeBy)
+
+    return (rExp * annFact), (rDisp * np.sqrt(annFact))
+
+
+def annualize_factor(annualizeBy):
+    """Return the factor that scales returns in the time frame 
+    annualizeBy to annual returns (dispersions scale by its sqrt).
+
+    :param annualizeBy: str, time frame the returns were calculated in,
+                        'None' or 'Y' (1), 'Q' (4), 'M' (12), 'W' (52) 
+                        or 'D' (252, number of open trading days a year)
+    :return:    int, annualizing factor
+    """
     if annualizeBy=='None' or annualizeBy=='Y':
         annFact = 1
+    elif annualizeBy=='Q':
+        annFact = 4
     elif annualizeBy=='M':
         annFact = 12
+    elif annualizeBy=='W':
+        annFact = 52
     elif annualizeBy=='D':
         annFact = 252 # number of open trading days a year
     else:
         raise Exception('Unknown way to annualize by '+annualizeBy)
 
-    return (rExp * annFact), (rDisp * np.sqrt(annFact))
-
-
+    return annFact
+
+
+def random_portfolio_blocks(rExps, rCoDispSq, nSamples, blockSize=10000, 
+        concentration=1, annualizeBy='None', seed=None):
+    """Generator of random long only portfolios and their performance, 
+    see asset_set_perform, drawn in blocks so memory is bounded by the 
+    block size regardless of the number of samples.
+    Weights are drawn from a Dirichlet distribution (uniform over the 
+    simplex for concentration of one, more concentrated on few assets 
+    below one). Per block the returns are one matrix vector product and 
+    the dispersions a row wise quadratic form, with C = L L' (Cholesky) 
+    w'Cw is the row sum of squares of W L. 
+    If rCoDispSq is not positive definite (robust estimates can be not) 
+    the quadratic form is evaluated directly.
+
+    :param rExps:   float array, asset expected returns, length n
+    :param rCoDispSq:   float array 2D, estimated co-dispersion squared 
+                        of returns, nxn
+    :param nSamples:    int, total number of portfolios to draw
+    :param blockSize:   int, portfolios per block
+    :param concentration:   float, Dirichlet concentration parameter
+    :param annualizeBy: str, time frame to annualize by (see annualize)
+    :param seed:    int, seed for the random generator
+    :yield weights: float array 2D, block x n weights
+    :yield portReturns: float array, expected return per portfolio
+    :yield portDisps:   float array, dispersion per portfolio
+    """
+    rExps = np.asarray(rExps, dtype=float)
+    rCoDispSq = np.asarray(rCoDispSq, dtype=float)
+    n = len(rExps)
+    annFact = annualize_factor(annualizeBy)
+    rng = np.random.default_rng(seed)
+    alpha = np.ones(n) * concentration
+
+    try:
+        L = np.linalg.cholesky(rCoDispSq)
+    except np.linalg.LinAlgError:
+        L = None
+
+    done = 0
+    while done < nSamples:
+        m = min(blockSize, nSamples - done)
+        w = rng.dirichlet(alpha, size=m)
+        portReturns = w @ rExps
+        if L is not None:
+            z = w @ L
+            dispSq = np.einsum('ij,ij->i', z, z)
+        else:
+            dispSq = np.einsum('ij,ij->i', w @ rCoDispSq, w)
+            # a non positive definite matrix can give small negatives
+            dispSq = np.maximum(dispSq, 0)
+        done += m
+
+        yield w, portReturns * annFact, np.sqrt(dispSq * annFact)
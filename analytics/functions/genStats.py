@@ -7,6 +7,7 @@ from statsmodels.regression.linear_model import OLS
 from statsmodels.tools import add_constant
 from statsmodels.tsa import stattools
 from scipy import stats
+import warnings
 
 
 def fit_model(X,y):
@@ -333,5 +334,182 @@ def expected(x, method='Robust'):
     return xExp
 
 
+# Batched versions of expected, disper and codisper_sq for many data 
+# sets of the same shape at once, e.g. the sampling phases of a 
+# return series (see CondorCoreObs.TimeCourse.sample_phases), 
+# x is (set, observation, variable) and all sets are done in 
+# vectorized passes. Nan values are removed as in the single set versions.
+
+def _nanmedian_obs(x):
+    # nan removed median over the observations (axis 1), kept as a 
+    # length one axis: one sort (nans go last) and a gather of the 
+    # middle values, much faster than np.nanmedian over many columns
+    xs = np.sort(x, axis=1)
+    count = np.sum(~np.isnan(x), axis=1, keepdims=True)
+    lo = np.take_along_axis(xs, np.maximum(count - 1, 0) // 2, axis=1)
+    hi = np.take_along_axis(xs, count // 2, axis=1)
+    # no observations, nan
+    hi = np.where(count == 0, np.nan, hi)
+    return (lo + hi) / 2
+
+def expected_phases(x, method='Robust'):
+    """Expected value of each variable in each set, see expected.
+    :param x:   float array 3D, (set, observation, variable)
+    :param method:  str, Robust (median) or Normal (mean)
+    :return:    float array 2D, (set, variable)
+    """
+    with warnings.catch_warnings():
+        # sets without observations give nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method=='Robust':
+            return _nanmedian_obs(x)[:, 0]
+        elif method=='Normal':
+            return np.nanmean(x, axis=1)
+    raise Exception('Method not known: '+method)
+
+def codisper_sq_phases(x, method='CoMAD', blockSize=2**22):
+    """Squared co-dispersion matrix of each set, see codisper_sq,
+    with the same pairwise removal of nan observations (the centers 
+    of a pair are taken over the observations both have).
+    The variables are done in blocks of rows so the pairwise 
+    (set, observation, row, variable) arrays stay near blockSize values.
+    :param x:   float array 3D, (set, observation, variable)
+    :param method:  str, CoMAD or Normal
+    :param blockSize:   int, approximate size of the working arrays
+    :return:    float array 3D, (set, variable, variable)
+    """
+    if method not in ('CoMAD', 'Normal'):
+        raise Exception('Method name not known: '+method)
+    nSet, nObs, n = x.shape
+    # Normal correction factor for mad -> st dev (see comad)
+    cor = 1.4826
+    present = ~np.isnan(x)
+    cosigma = np.zeros((nSet, n, n))*np.nan
+    nRows = max(1, blockSize // max(1, nSet*nObs*n))
+    with warnings.catch_warnings():
+        # pairs without common observations give nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i0 in range(0, n, nRows):
+            i1 = min(n, i0 + nRows)
+            # observations of rows i and variables j where both are present
+            both = present[:, :, i0:i1, np.newaxis] & present[:, :, np.newaxis, :]
+            xi = np.where(both, x[:, :, i0:i1, np.newaxis], np.nan)
+            xj = np.where(both, x[:, :, np.newaxis, :], np.nan)
+            if method=='CoMAD':
+                di = xi - _nanmedian_obs(xi)
+                dj = xj - _nanmedian_obs(xj)
+                cosigma[:, i0:i1] = _nanmedian_obs(di * dj)[:, 0] * cor**2
+            else:
+                di = xi - np.nanmean(xi, axis=1, keepdims=True)
+                dj = xj - np.nanmean(xj, axis=1, keepdims=True)
+                cosigma[:, i0:i1] = np.nansum(di * dj, axis=1) / (np.sum(both, axis=1) - 1)
+
+    return cosigma
+
     
         
+
+
+class FactorCoDispSq:
+    """Squared co-dispersion matrix in low rank factor form
+        C = B B' + diag(d)
+    with B the n x k factor loadings and d the n specific (residual) 
+    dispersions squared, see fit_factor_codisper_sq.
+
+    Products with weights are done in factor form, C @ w and w @ C 
+    (w 1D or a 2D stack of weights) take O(nk) instead of O(n^2), so the 
+    objects can be passed wherever a co-dispersion matrix is multiplied 
+    (e.g. genFin.asset_set_perform and the portOpt SLSQP objectives). 
+    Anything that needs the entries (np.asarray, np.diag, indexing) 
+    gets the full n x n matrix.
+    """
+    # let numpy hand w @ C to __rmatmul__ instead of converting C
+    __array_ufunc__ = None
+
+    def __init__(self, B, d):
+        self.B = np.asarray(B, dtype=float)
+        self.d = np.asarray(d, dtype=float)
+        n = len(self.d)
+        self.shape = (n, n)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def full(self):
+        """:return:    float array 2D, the full n x n matrix"""
+        return self.B @ self.B.T + np.diag(self.d)
+
+    def diag(self):
+        """:return:    float array, the n diagonal entries (dispersions squared)"""
+        return np.sum(self.B**2, axis=1) + self.d
+
+    def subset(self, inds):
+        """:param inds:    int array, asset indices
+        :return:    FactorCoDispSq, the model for the asset subset inds"""
+        return FactorCoDispSq(self.B[inds], self.d[inds])
+
+    def __array__(self, dtype=None, copy=None):
+        C = self.full()
+        if dtype is not None:
+            C = C.astype(dtype)
+        return C
+
+    def __getitem__(self, key):
+        return self.full()[key]
+
+    def __matmul__(self, w):
+        w = np.asarray(w)
+        d = self.d if w.ndim == 1 else self.d[:, np.newaxis]
+        return self.B @ (self.B.T @ w) + d * w
+
+    def __rmatmul__(self, w):
+        w = np.asarray(w)
+        return (w @ self.B) @ self.B.T + w * self.d
+
+
+def fit_factor_codisper_sq(x, nFactors, method='CoMAD'):
+    """Fit a k factor plus diagonal model of the squared co-dispersion 
+    of the data set, x, see FactorCoDispSq. 
+    The factors are the first nFactors principal components of the 
+    correlation of the (centered and scaled) variables, the diagonal is 
+    set so the variable dispersions squared are exact for the method. 
+    With many variables and few observations this is less noisy than 
+    the full matrix, and it is always positive definite.
+
+    :param x:   float array 2D, data set with cols as variables and 
+                rows as paired observations (e.g. same time point)
+    :param nFactors:    int, number of factors k
+    :param method:  str, method used for the centers and dispersions
+        Possibilities
+            CoMAD (default) median and normal adjusted MAD
+            Normal          mean and standard deviation
+    :return:    FactorCoDispSq, the fitted model
+
+    Note: nan values are set to the center (zero deviation) before the 
+    principal components, they do not add to the correlation
+    """
+    if method=='CoMAD':
+        center = np.nanmedian(x, axis=0)
+        disp = stats.median_abs_deviation(x, axis=0, scale='normal', nan_policy='omit')
+    elif method=='Normal':
+        center = np.nanmean(x, axis=0)
+        disp = np.nanstd(x, axis=0, ddof=1)
+    else:
+        raise Exception('Method name not known: '+method)
+    disp = np.asarray(disp)
+
+    # standardized deviations, nan as no deviation
+    z = np.nan_to_num(x - center)
+    scale = np.sqrt(np.sum(z**2, axis=0) / (len(z) - 1))
+    scale[scale == 0] = 1
+    z = z / scale
+
+    nFactors = min(nFactors, min(z.shape))
+    _, s, vt = np.linalg.svd(z / np.sqrt(len(z) - 1), full_matrices=False)
+    loadings = vt[:nFactors].T * s[:nFactors]
+    # the correlation has a unit diagonal, what the factors do not 
+    # explain is specific to each variable (kept from reaching zero)
+    specific = np.maximum(1 - np.sum(loadings**2, axis=1), 1e-8)
+
+    return FactorCoDispSq(loadings * disp[:, np.newaxis], specific * disp**2)
@@ -4,77 +4,730 @@
 # There is no warranty or guarantee of any kind 
 
 import numpy as np
+import multiprocessing as mp
 import scipy.optimize as spOpt
+import scipy.cluster.hierarchy as spHier
+import scipy.spatial.distance as spDist
 from . import genStats as gs
 from . import genFin as gf
+from . import profiling
 
-def max_sharpe_ratio(rExps, rCoDispSq, riskFreeRate=0, constraintSet=(0, 1), annualizeBy='None'):
+
+class OptimizationError(Exception):
+    # Raised by the solvers when a problem has no solution (e.g. no 
+    # feasible portfolio) or the solver did not converge. Batch style 
+    # callers (batch_optimize, subsetSearch, walkForward) catch this 
+    # by name and record a failed problem, anything else is a bug.
+    # The SLSQP solvers do not raise, they report success=False.
+    pass
+
+# lean objective and constraint functions for the optimizers.
+# These skip the weight checks and annualize branching in genFin 
+# (the factor is resolved once per solve) and return the value together 
+# with its analytic gradient, so SLSQP does not need n extra finite 
+# difference evaluations per iteration. With f the annualizing factor,
+# r = f rExps'w and s = sqrt(f w'Cw):
+#   d (-(r - rf)/s) / dw = -( f rExps - (r - rf) f C w / s^2 ) / s
+#   d sqrt(f w'Cw) / dw = sqrt(f) C w / sqrt(w'Cw)
+
+def _neg_sharpe_ratio_and_grad(w, rExps, rCoDispSq, riskFreeRate, annFact):
+    cw = rCoDispSq @ w
+    dispSq = annFact * (w @ cw)
+    disp = np.sqrt(dispSq)
+    excess = annFact * (rExps @ w) - riskFreeRate
+    grad = -(annFact * rExps - excess * annFact * cw / dispSq) / disp
+    return -excess / disp, grad
+
+def _disp_and_grad(w, rCoDispSq, annFact):
+    cw = rCoDispSq @ w
+    disp = np.sqrt(w @ cw)
+    sqrtFact = np.sqrt(annFact)
+    return sqrtFact * disp, sqrtFact * cw / disp
+
+def _weight_sum_constraint(n):
+    # f(x)=0 when the weights sum to one, with its (constant) jacobian
+    ones = np.ones(n)
+    return {'type': 'eq', 'fun': lambda x: np.sum(x) - 1, 'jac': lambda x: ones}
+
+def _return_target_constraint(rExps, annFact, returnTarget):
+    # f(x)=0 when the (annualized) expected return hits the target
+    grad = annFact * np.asarray(rExps)
+    return {'type': 'eq', 'fun': lambda x: grad @ x - returnTarget, 'jac': lambda x: grad}
+
+
+# the dispersion and expected return of weights w, as asset_set_perform 
+# without the weight checks, kept for older callers (e.g. the project 
+# notebooks), the optimizers use the lean functions above
+def _asset_set_disp(w, rExps, rCoDispSq, annualizeBy='None'):
+    return _disp_and_grad(np.asarray(w), rCoDispSq, gf.annualize_factor(annualizeBy))[0]
+
+def _asset_set_exp(w, rExps, rCoDispSq, annualizeBy='None'):
+    return gf.annualize_factor(annualizeBy) * (np.asarray(rExps) @ np.asarray(w))
+
+
+@profiling.profiled('portOpt.max_sharpe_ratio')
+def max_sharpe_ratio(rExps, rCoDispSq, riskFreeRate=0, constraintSet=(0, 1), annualizeBy='None', initGuess=None):
     # number of assets
     n = len(rExps)
     # set the additional, fixed, arguments for the 
-    # function to be minimized, asset_set_neg_sharpe_ratio
-    args = (rExps, rCoDispSq, riskFreeRate, annualizeBy)
-    # set initial guess for the function to be mined
-    initGuess = n * [1. / n]
+    # function to be minimized, the lean negative sharpe ratio
+    args = (rExps, rCoDispSq, riskFreeRate, gf.annualize_factor(annualizeBy))
+    # set initial guess for the function to be mined, equal weights unless passed
+    if initGuess is None:
+        initGuess = n * [1. / n]
     # set constraints, f(output)=0, for function to be mined
-    constraints = ({'type': 'eq', 'fun': lambda x: np.sum(x) - 1})
+    constraints = (_weight_sum_constraint(n),)
     # set the bounds, (min,max), for the function to be mined
     bounds = tuple(constraintSet for asset in range(n))
     # call scipy optimal minimizer by sequental least squares quadratic programing
-    result = spOpt.minimize(gf.asset_set_neg_sharpe_ratio, initGuess, 
-            args=args, method='SLSQP', bounds=bounds, constraints=constraints)
+    # jac=True as the objective returns its gradient too
+    result = spOpt.minimize(_neg_sharpe_ratio_and_grad, initGuess, 
+            args=args, method='SLSQP', jac=True, bounds=bounds, constraints=constraints)
     return result
 
-# sub function to calculate the performace and only return the dispersion
-def _asset_set_disp(w, rExps, rCoDispSq, annualizeBy='None'):
-    tmp = gf.asset_set_perform(w, rExps, rCoDispSq, annualizeBy=annualizeBy)[1]
-    return tmp
-
-
-# sub function to calculate the performace and only return the expected return
-def _asset_set_exp(w, rExps, rCoDispSq, annualizeBy='None'):
-    tmp = gf.asset_set_perform(w, rExps, rCoDispSq, annualizeBy=annualizeBy)[0]
-    return tmp
-
-
-def min_dispersion(rExps, rCoDispSq, constraintSet=(0, 1), annualizeBy='None',returnTarget=''):
+@profiling.profiled('portOpt.min_dispersion')
+def min_dispersion(rExps, rCoDispSq, constraintSet=(0, 1), annualizeBy='None',returnTarget='', initGuess=None):
     # note that the targets sent in have to match the annulization 
     # but the properties are pre annualized and then annualized here.
     # we need to clean this up
     # number of assets
     n = len(rExps)
+    annFact = gf.annualize_factor(annualizeBy)
     # set the additional, fixed, arguments for the 
-    # function to be minimized, asset_set_disp
-    args = (rExps, rCoDispSq, annualizeBy)
-    # set initial guess for the function to be mined
-    initGuess = n * [1. / n]
+    # function to be minimized, the lean dispersion
+    args = (rCoDispSq, annFact)
+    # set initial guess for the function to be mined, equal weights unless passed
+    if initGuess is None:
+        initGuess = n * [1. / n]
     # set constraints, f(output)=0, for function to be mined
     if returnTarget == '':
         # no target return so no constraint there, just on the wieghts summing to zero
-        constraints = ({'type': 'eq', 'fun': lambda x: np.sum(x) - 1})
+        constraints = (_weight_sum_constraint(n),)
     else:
         # a target return constraint needs to be included
-        constraints = ({'type': 'eq', 'fun': lambda x: _asset_set_exp(x, rExps, rCoDispSq, annualizeBy) - returnTarget},
-                {'type': 'eq', 'fun': lambda x: np.sum(x) - 1})
+        constraints = (_return_target_constraint(rExps, annFact, returnTarget),
+                _weight_sum_constraint(n))
 
     # set the bounds, (min,max), for the function to be mined
     bounds = tuple(constraintSet for asset in range(n))
     # call scipy optimal minimizer by sequental least squares quadratic programing        
-    result = spOpt.minimize(_asset_set_disp, initGuess, args=args,
-                         method='SLSQP', bounds=bounds, constraints=constraints)
+    # jac=True as the objective returns its gradient too
+    result = spOpt.minimize(_disp_and_grad, initGuess, args=args,
+                         method='SLSQP', jac=True, bounds=bounds, constraints=constraints)
     return result
 
-def calc_efficient_frontier(rExps, rCoDispSq, rTargetRange, riskFreeRate=0, constraintSet=(0, 1), annualizeBy='None'):
-    # init solution vars
-    n = len(rTargetRange)
+def _solve_frontier_chunk(args):
+    # solve a contiguous run of frontier targets in order,
+    # optionally starting each solve from the previous solution
+    rExps, rCoDispSq, rTargets, constraintSet, annualizeBy, warmStart = args
+    n = len(rTargets)
     m = len(rExps)
     weights = np.zeros((n,m))*np.nan
-
+    success = np.zeros(n, dtype=bool)
+    initGuess = None
     for i in range(n):
-        rTarget = rTargetRange[i]
-        optResult = min_dispersion(rExps, rCoDispSq, annualizeBy=annualizeBy,returnTarget=rTarget)
-        weights[i]=optResult['x']
+        optResult = min_dispersion(rExps, rCoDispSq, constraintSet=constraintSet,
+                annualizeBy=annualizeBy, returnTarget=rTargets[i], initGuess=initGuess)
+        weights[i] = optResult['x']
+        success[i] = optResult['success']
+        if warmStart and optResult['success']:
+            # neighboring targets have nearly the same solution
+            initGuess = optResult['x']
+
+    return weights, success
+
+def _frontier_output(weights, success, rExps, rCoDispSq, riskFreeRate, annualizeBy, 
+        returnStatus, returnSharpe):
+    # the frontier results as requested, the Sharpe ratios are of the 
+    # weights as solved (no weight sum check, failed rows may be off)
+    out = (weights,)
+    if returnStatus:
+        out += (success,)
+    if returnSharpe:
+        annFact = gf.annualize_factor(annualizeBy)
+        rets = annFact * (weights @ np.asarray(rExps))
+        disps = np.sqrt(annFact * np.einsum('ij,ij->i', weights @ np.asarray(rCoDispSq), weights))
+        out += ((rets - riskFreeRate) / disps,)
+    if len(out) == 1:
+        return weights
+    return out
+
+@profiling.profiled('portOpt.calc_efficient_frontier')
+def calc_efficient_frontier(rExps, rCoDispSq, rTargetRange, riskFreeRate=0, constraintSet=(0, 1), 
+        annualizeBy='None', warmStart=False, nProc=1, returnStatus=False, returnSharpe=False):
+    # Solve for the min dispersion weights at each target return in rTargetRange.
+    # warmStart - start each solve from the previous target's solution 
+    #   (targets should be in order) instead of equal weights
+    # nProc - split the targets into nProc contiguous chunks and solve the 
+    #   chunks in parallel worker processes (warm starts run within a chunk)
+    # returnStatus - also return a bool array with the convergence 
+    #   status reported by the optimizer for each target
+    # returnSharpe - also return the Sharpe ratio of each frontier 
+    #   portfolio against riskFreeRate (annualized if annualizeBy is 
+    #   set), after the status if both are returned
+    n = len(rTargetRange)
+    chunks = np.array_split(np.arange(n), max(1, min(nProc, n)))
+    tasks = [(rExps, rCoDispSq, np.asarray(rTargetRange)[inds], constraintSet, 
+            annualizeBy, warmStart) for inds in chunks]
+
+    if len(tasks) > 1:
+        with mp.Pool(processes=len(tasks)) as pool:
+            results = pool.map(_solve_frontier_chunk, tasks)
+    else:
+        results = [_solve_frontier_chunk(tasks[0])]
+
+    weights = np.concatenate([res[0] for res in results])
+    success = np.concatenate([res[1] for res in results])
+
+    return _frontier_output(weights, success, rExps, rCoDispSq, riskFreeRate, 
+            annualizeBy, returnStatus, returnSharpe)
+
+def _frontier_refine_scores(rets, disps, weights, weightTol, curveTol):
+    # score the intervals between neighboring frontier points, above one
+    # needs a new target: the weights change by more than weightTol (sum of
+    # absolute changes) or the curve turns by more than curveTol (radians,
+    # in return and dispersion scaled to the frontier's range) at either end
+    scores = np.sum(np.abs(np.diff(weights, axis=0)), axis=1) / weightTol
+    rSpan = np.nanmax(rets) - np.nanmin(rets)
+    dSpan = np.nanmax(disps) - np.nanmin(disps)
+    if len(rets) > 2 and rSpan > 0 and dSpan > 0:
+        theta = np.arctan2(np.diff(rets) / rSpan, np.diff(disps) / dSpan)
+        turn = np.abs(np.diff(theta)) / curveTol
+        scores[:-1] = np.fmax(scores[:-1], turn)
+        scores[1:] = np.fmax(scores[1:], turn)
+    return np.nan_to_num(scores)
+
+@profiling.profiled('portOpt.refine_efficient_frontier')
+def refine_efficient_frontier(rExps, rCoDispSq, rTargets, weights, success, constraintSet=(0, 1),
+        annualizeBy='None', weightTol=0.05, curveTol=0.02, maxPoints=101):
+    # Adaptive refinement of a frontier solved at the (sorted) targets rTargets,
+    # e.g. by calc_efficient_frontier with returnStatus.
+    # New targets are put at the middle of intervals flagged by weight or
+    # curvature change (see _frontier_refine_scores), each solved from the
+    # average of its neighbors' weights, until nothing is flagged or there
+    # are maxPoints targets (then the highest scores go first).
+    # Returns the merged targets, weights and status.
+    rTargets = np.asarray(rTargets, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    success = np.asarray(success, dtype=bool)
+
+    while len(rTargets) < maxPoints:
+        rets, disps = gf.asset_set_perform(weights, rExps, rCoDispSq, annualizeBy=annualizeBy)
+        scores = _frontier_refine_scores(rets, disps, weights, weightTol, curveTol)
+        inds = np.where(scores > 1)[0]
+        if len(inds) == 0:
+            break
+        # worst half of the flagged intervals per pass (at least one), so the
+        # budget goes where the scores are high rather than doubling everywhere
+        nNew = min(max(1, len(inds) // 2), maxPoints - len(rTargets))
+        inds = np.sort(inds[np.argsort(-scores[inds])][:nNew])
+
+        newTargets = (rTargets[inds] + rTargets[inds+1]) / 2
+        newWeights = np.zeros((len(inds), weights.shape[1])) * np.nan
+        newSuccess = np.zeros(len(inds), dtype=bool)
+        for k, i in enumerate(inds):
+            initGuess = (weights[i] + weights[i+1]) / 2
+            if not np.all(np.isfinite(initGuess)):
+                initGuess = None
+            optResult = min_dispersion(rExps, rCoDispSq, constraintSet=constraintSet,
+                    annualizeBy=annualizeBy, returnTarget=newTargets[k], initGuess=initGuess)
+            newWeights[k] = optResult['x']
+            newSuccess[k] = optResult['success']
+
+        rTargets = np.insert(rTargets, inds+1, newTargets)
+        weights = np.insert(weights, inds+1, newWeights, axis=0)
+        success = np.insert(success, inds+1, newSuccess)
+
+    return rTargets, weights, success
+
+
+# Critical Line Algorithm (CLA) for the efficient frontier.
+# With box constraints on the weights (e.g. the default long only 
+# constraintSet=(0, 1)) the frontier is made of straight segments, in 
+# weight space, between a finite set of corner (turning) portfolios.
+# Along a segment the set of free (not at a bound) assets does not change 
+# so the weights are linear in the target return and can be interpolated 
+# exactly between corners, no optimizer is needed.
+# Follows Bailey and Lopez de Prado (2013), An Open-Source Implementation 
+# of the Critical-Line Algorithm for Portfolio Optimization.
+
+def _cla_matrices(cov, mean, w, f):
+    # split into free (f) and bounded (b) parts
+    b = [i for i in range(len(mean)) if i not in f]
+    covF = cov[np.ix_(f, f)]
+    covFB = cov[np.ix_(f, b)]
+    meanF = mean[f]
+    wB = w[b]
+    return covF, covFB, meanF, wB
+
+def _cla_lambda(covFInv, covFB, meanF, wB, i, bi):
+    # lambda at which free asset i (index into f) would reach bi,
+    # if bi is a (lower, upper) pair the bound is picked by the sign of c
+    onesF = np.ones(len(meanF))
+    c1 = onesF @ covFInv @ onesF
+    c2 = covFInv @ meanF
+    c3 = onesF @ covFInv @ meanF
+    c4 = covFInv @ onesF
+    c = -c1 * c2[i] + c3 * c4[i]
+    if c == 0:
+        return None, None
+    if isinstance(bi, tuple):
+        bi = bi[1] if c > 0 else bi[0]
+    if len(wB) == 0:
+        return (c4[i] - c1 * bi) / c, bi
+    l1 = np.sum(wB)
+    l3 = covFInv @ (covFB @ wB)
+    l2 = onesF @ l3
+    return ((1 - l1 + l2) * c4[i] - c1 * (bi + l3[i])) / c, bi
+
+def _cla_weights(covFInv, covFB, meanF, wB, lam):
+    # weights of the free assets (and gamma) on the critical line at lam
+    onesF = np.ones(len(meanF))
+    g1 = onesF @ covFInv @ meanF
+    g2 = onesF @ covFInv @ onesF
+    if len(wB) == 0:
+        g = -lam * g1 / g2 + 1 / g2
+        w1 = 0
+    else:
+        g3 = np.sum(wB)
+        w1 = covFInv @ (covFB @ wB)
+        g4 = onesF @ w1
+        g = -lam * g1 / g2 + (1 - g3 + g4) / g2
+    w2 = covFInv @ onesF
+    w3 = covFInv @ meanF
+    return -w1 + g * w2 + lam * w3, g
+
+@profiling.profiled('portOpt.calc_cla_corners')
+def calc_cla_corners(rExps, rCoDispSq, constraintSet=(0, 1), tol=1e-9):
+    """Find the corner portfolios of the efficient frontier with the 
+    Critical Line Algorithm, for weights bounded by constraintSet and 
+    summing to one.
+
+    :param rExps:   float array, asset expected returns (n)
+    :param rCoDispSq:   float array 2D, co-dispersion squared of returns (nxn),
+                        must be positive definite for the free sub matrices
+    :param constraintSet:   (float, float), (min, max) bounds for every weight 
+                            or a pair of float arrays with per asset bounds
+    :param tol: float, numerical tolerance used to purge bad corners
+    :return cornerWeights:  float array 2D, one corner portfolio per row, 
+                            from the max return to the min dispersion portfolio
+    :return lambdas:    float array, risk aversion value of each corner 
+                        (inf for the max return corner, 0 for min dispersion)
+    """
+    mean = np.asarray(rExps, dtype=float)
+    cov = np.asarray(rCoDispSq, dtype=float)
+    n = len(mean)
+    lB = np.broadcast_to(np.asarray(constraintSet[0], dtype=float), (n,)).copy()
+    uB = np.broadcast_to(np.asarray(constraintSet[1], dtype=float), (n,)).copy()
+    if np.sum(lB) > 1 + tol or np.sum(uB) < 1 - tol:
+        raise OptimizationError('No weights within constraintSet can sum to one.')
+
+    # start at the max return portfolio, fill the best assets up to 
+    # their upper bound, the asset that crosses one is the free one
+    order = np.argsort(mean, kind='stable')
+    w = lB.copy()
+    i = n
+    while np.sum(w) < 1:
+        i -= 1
+        w[order[i]] = uB[order[i]]
+    w[order[i]] += 1 - np.sum(w)
+    f = [order[i]]
+
+    ws = [w.copy()]
+    lambdas = [np.inf]
+    while True:
+        # case a) bind one free weight
+        lIn = -np.inf
+        if len(f) > 1:
+            covF, covFB, meanF, wB = _cla_matrices(cov, mean, w, f)
+            covFInv = np.linalg.inv(covF)
+            for j in range(len(f)):
+                l, bi = _cla_lambda(covFInv, covFB, meanF, wB, j, (lB[f[j]], uB[f[j]]))
+                if l is not None and l > lIn:
+                    lIn, iIn, biIn = l, f[j], bi
+
+        # case b) free one bounded weight
+        lOut = -np.inf
+        if len(f) < n:
+            for i in [k for k in range(n) if k not in f]:
+                covF, covFB, meanF, wB = _cla_matrices(cov, mean, w, f+[i])
+                covFInv = np.linalg.inv(covF)
+                l, bi = _cla_lambda(covFInv, covFB, meanF, wB, len(meanF)-1, w[i])
+                if l is not None and l < lambdas[-1] and l > lOut:
+                    lOut, iOut = l, i
 
-    return weights
+        if lIn < 0 and lOut < 0:
+            # no more turning points, finish at the min dispersion portfolio
+            lam = 0
+            covF, covFB, meanF, wB = _cla_matrices(cov, mean, w, f)
+            covFInv = np.linalg.inv(covF)
+            meanF = np.zeros(len(meanF))
+        else:
+            if lIn > lOut:
+                lam = lIn
+                f.remove(iIn)
+                w[iIn] = biIn
+            else:
+                lam = lOut
+                f.append(iOut)
+            covF, covFB, meanF, wB = _cla_matrices(cov, mean, w, f)
+            covFInv = np.linalg.inv(covF)
 
+        wF, g = _cla_weights(covFInv, covFB, meanF, wB, lam)
+        w[f] = wF
+        ws.append(w.copy())
+        lambdas.append(lam)
+        if lam == 0:
+            break
+
+    ws = np.array(ws)
+    lambdas = np.array(lambdas)
+
+    # purge corners broken by numerical error 
+    keep = ((np.abs(np.sum(ws, axis=1) - 1) <= tol) & 
+            np.all(ws >= lB - tol, axis=1) & np.all(ws <= uB + tol, axis=1))
+    ws = ws[keep]
+    lambdas = lambdas[keep]
+    # purge corners with a lower return than a later (less risky) corner
+    mus = ws @ mean
+    keep = mus >= np.maximum.accumulate(mus[::-1])[::-1] - tol
+    ws = ws[keep]
+    lambdas = lambdas[keep]
+
+    return ws, lambdas
+
+@profiling.profiled('portOpt.calc_efficient_frontier_cla')
+def calc_efficient_frontier_cla(rExps, rCoDispSq, rTargetRange, riskFreeRate=0, constraintSet=(0, 1), 
+        annualizeBy='None', returnStatus=False, cornerWeights=None, returnSharpe=False):
+    # Same inputs and outputs as calc_efficient_frontier, but exact:
+    # the corner portfolios are found once with calc_cla_corners and the 
+    # weights at each target return are interpolated between the two 
+    # corners around it.
+    # Targets outside the frontier's return range are clipped to the 
+    # nearest end and flagged as failed in the returned status.
+    # Precalculated corners can be passed in as cornerWeights.
+    if cornerWeights is None:
+        cornerWeights, _ = calc_cla_corners(rExps, rCoDispSq, constraintSet=constraintSet)
+
+    # targets are in annualized units if annualizeBy is set
+    annFact = gf.annualize_factor(annualizeBy)
+    mus = cornerWeights @ np.asarray(rExps) * annFact
+    rTargets = np.asarray(rTargetRange, dtype=float)
+
+    # np.interp needs increasing returns, corners go from high to low
+    musUp = mus[::-1]
+    wUp = cornerWeights[::-1]
+    weights = np.empty((len(rTargets), wUp.shape[1]))
+    for j in range(wUp.shape[1]):
+        weights[:, j] = np.interp(rTargets, musUp, wUp[:, j])
+
+    tol = gf.eps * max(1, musUp[-1] - musUp[0])
+    success = (rTargets >= musUp[0] - tol) & (rTargets <= musUp[-1] + tol)
+
+    return _frontier_output(weights, success, rExps, rCoDispSq, riskFreeRate, 
+            annualizeBy, returnStatus, returnSharpe)
+
+
+# Convex (QP) solvers for the long only case.
+# The max Sharpe ratio (tangency) portfolio is found with the standard 
+# reformulation: minimize y' C y subject to (rExps - rf)' y = 1 and y >= 0, 
+# then w = y / sum(y). This is a convex quadratic program, so unlike 
+# minimizing the negative Sharpe ratio there are no poor local solutions.
+# The min dispersion portfolio is the same QP with a vector of ones.
+
+def _qp_active_set(Q, a, tol=1e-12, maxIter=None):
+    # Primal active set solver for: min 1/2 y'Qy  s.t.  a'y = 1, y >= 0
+    # returns the solution y and the number of iterations
+    # Q must be positive definite on the free sub matrices
+    n = len(a)
+    if maxIter is None:
+        maxIter = 10 * n + 50
+
+    # feasible start: all in the asset with the largest a
+    i0 = int(np.argmax(a))
+    if a[i0] <= 0:
+        raise OptimizationError('No feasible portfolio, all expected excess returns are zero or negative.')
+    y = np.zeros(n)
+    y[i0] = 1 / a[i0]
+    free = [i0]
+
+    for nit in range(1, maxIter+1):
+        # solve the equality constrained problem on the free set
+        # Q_FF y_F - nu a_F = 0,  a_F' y_F = 1
+        m = len(free)
+        kkt = np.zeros((m+1, m+1))
+        kkt[:m, :m] = Q[np.ix_(free, free)]
+        kkt[:m, m] = -a[free]
+        kkt[m, :m] = a[free]
+        rhs = np.zeros(m+1)
+        rhs[m] = 1
+        try:
+            sol = np.linalg.solve(kkt, rhs)
+        except np.linalg.LinAlgError:
+            sol = np.linalg.lstsq(kkt, rhs, rcond=None)[0]
+        yF, nu = sol[:m], sol[m]
+
+        if np.all(yF >= -tol):
+            # full step, check the multipliers of the bounded assets
+            y[:] = 0
+            y[free] = np.maximum(yF, 0)
+            mult = Q @ y - nu * a
+            mult[free] = 0
+            iMin = int(np.argmin(mult))
+            if mult[iMin] >= -tol * max(1, np.abs(nu)):
+                return y, nit
+            free.append(iMin)
+        else:
+            # blocked step, move until the first free weight hits zero
+            yCur = y[free]
+            d = yF - yCur
+            blocking = d < 0
+            ratios = np.full(m, np.inf)
+            ratios[blocking] = yCur[blocking] / -d[blocking]
+            j = int(np.argmin(ratios))
+            y[free] = yCur + ratios[j] * d
+            y[free[j]] = 0
+            free.pop(j)
+
+    raise OptimizationError('QP active set solver did not converge in '+str(maxIter)+' iterations.')
+
+def _check_long_only(constraintSet):
+    # the QP solvers work on y >= 0, which is only the (0, 1) box
+    if constraintSet[0] != 0 or constraintSet[1] < 1:
+        raise Exception('The QP solvers only support long only weights, constraintSet=(0, 1). Use the SLSQP solvers for other bounds.')
+
+@profiling.profiled('portOpt.max_sharpe_ratio_qp')
+def max_sharpe_ratio_qp(rExps, rCoDispSq, riskFreeRate=0, constraintSet=(0, 1), annualizeBy='None'):
+    # Same inputs and result (scipy OptimizeResult, weights in 'x') as 
+    # max_sharpe_ratio but solved as a convex QP, see notes above.
+    # riskFreeRate is in annualized units if annualizeBy is set.
+    _check_long_only(constraintSet)
+    annFact = gf.annualize_factor(annualizeBy)
+    rExps = np.asarray(rExps, dtype=float)
+    cov = np.asarray(rCoDispSq, dtype=float)
+    # excess returns in the un-annualized units
+    excess = rExps - riskFreeRate / annFact
+
+    y, nit = _qp_active_set(cov, excess)
+    w = y / np.sum(y)
+    fun, jac = _neg_sharpe_ratio_and_grad(w, rExps, cov, riskFreeRate, annFact)
+
+    return spOpt.OptimizeResult(x=w, fun=fun, jac=jac, nit=nit, success=True,
+            status=0, message='Optimization terminated successfully (QP active set)')
+
+@profiling.profiled('portOpt.min_dispersion_qp')
+def min_dispersion_qp(rExps, rCoDispSq, constraintSet=(0, 1), annualizeBy='None'):
+    # Same inputs and result as min_dispersion (without a target return) 
+    # but solved directly as a QP on the weights.
+    _check_long_only(constraintSet)
+    annFact = gf.annualize_factor(annualizeBy)
+    cov = np.asarray(rCoDispSq, dtype=float)
+
+    w, nit = _qp_active_set(cov, np.ones(len(rExps)))
+    fun, jac = _disp_and_grad(w, cov, annFact)
+
+    return spOpt.OptimizeResult(x=w, fun=fun, jac=jac, nit=nit, success=True,
+            status=0, message='Optimization terminated successfully (QP active set)')
+
+
+# Hierarchical risk parity (HRP), no optimizer.
+# Assets are clustered by the correlation implied by the co-dispersion 
+# matrix (distance sqrt((1 - rho) / 2), single linkage) and put in the 
+# order of the cluster tree, so similar assets sit next to each other. 
+# The weights are then split top down: each run of assets is cut in two 
+# halves and the weight goes between them in inverse proportion to the 
+# dispersion squared of each half (each half weighted by inverse variance). 
+# The clustering is O(n^2 log n) and the bisection O(n^2 log n) at most, 
+# there are no iterations and no matrix inversion, so it scales to 
+# universes where the optimizers above cannot run. Expected returns are 
+# not used. Follows Lopez de Prado (2016), Building Diversified Portfolios 
+# that Outperform Out-of-Sample.
+
+def _hrp_order(cov):
+    # assets in the leaf order of the single linkage tree
+    disp = np.sqrt(np.diag(cov))
+    corr = np.clip(cov / np.outer(disp, disp), -1, 1)
+    dist = np.sqrt(0.5 * (1 - corr))
+    np.fill_diagonal(dist, 0)
+    link = spHier.linkage(spDist.squareform(dist, checks=False), method='single')
+    return spHier.leaves_list(link)
+
+def _hrp_cluster_var(cov, inds):
+    # dispersion squared of a cluster with inverse variance weights
+    sub = cov[np.ix_(inds, inds)]
+    ivp = 1 / np.diag(sub)
+    ivp = ivp / np.sum(ivp)
+    return ivp @ sub @ ivp
+
+@profiling.profiled('portOpt.hrp_weights')
+def hrp_weights(rExps, rCoDispSq, constraintSet=(0, 1), annualizeBy='None'):
+    # Same inputs and result shape (scipy OptimizeResult, weights in 'x', 
+    # dispersion in 'fun') as min_dispersion_qp, see notes above.
+    # Long only by construction.
+    _check_long_only(constraintSet)
+    annFact = gf.annualize_factor(annualizeBy)
+    cov = np.asarray(rCoDispSq, dtype=float)
+    n = cov.shape[0]
+
+    w = np.ones(n)
+    clusters = [_hrp_order(cov)] if n > 1 else []
+    nit = 0
+    while len(clusters) > 0:
+        nextClusters = []
+        for inds in clusters:
+            half = len(inds) // 2
+            left, right = inds[:half], inds[half:]
+            varLeft = _hrp_cluster_var(cov, left)
+            varRight = _hrp_cluster_var(cov, right)
+            alpha = 1 - varLeft / (varLeft + varRight)
+            w[left] *= alpha
+            w[right] *= 1 - alpha
+            nextClusters += [c for c in (left, right) if len(c) > 1]
+        clusters = nextClusters
+        nit += 1
+
+    fun, jac = _disp_and_grad(w, cov, annFact)
+
+    return spOpt.OptimizeResult(x=w, fun=fun, jac=jac, nit=nit, success=True,
+            status=0, message='Allocation by hierarchical risk parity')
+
+
+# Batch optimization of many (small) portfolios at once.
+# The problems are handed to a pool of worker processes in chunks, 
+# index subsets of one shared universe are sent to each worker only once 
+# (as the pool initializer) so only the indices travel per problem.
+
+_batchUniverse = None
+
+def _init_batch_worker(universe):
+    global _batchUniverse
+    _batchUniverse = universe
+
+def _solve_batch_problem(rExps, rCoDispSq, constraintSet, target, riskFreeRate, annualizeBy, solver):
+    if target == 'Sharpe Ratio':
+        if solver == 'QP':
+            res = max_sharpe_ratio_qp(rExps, rCoDispSq, riskFreeRate=riskFreeRate, 
+                    constraintSet=constraintSet, annualizeBy=annualizeBy)
+        else:
+            res = max_sharpe_ratio(rExps, rCoDispSq, riskFreeRate=riskFreeRate, 
+                    constraintSet=constraintSet, annualizeBy=annualizeBy)
+    elif target == 'Dispersion':
+        if solver == 'QP':
+            res = min_dispersion_qp(rExps, rCoDispSq, constraintSet=constraintSet, 
+                    annualizeBy=annualizeBy)
+        else:
+            res = min_dispersion(rExps, rCoDispSq, constraintSet=constraintSet, 
+                    annualizeBy=annualizeBy)
+    elif target == 'HRP':
+        res = hrp_weights(rExps, rCoDispSq, constraintSet=constraintSet, 
+                annualizeBy=annualizeBy)
+    else:
+        raise Exception('Target set for optimization not known: '+target)
+    return res['x'], res['fun'], res['success']
+
+def _batch_worker(args):
+    problem, constraintSet, target, riskFreeRate, annualizeBy, solver = args
+    try:
+        if _batchUniverse is not None:
+            # problem is an index subset of the shared universe
+            inds = np.asarray(problem)
+            rExps = _batchUniverse[0][inds]
+            rCoDispSq = _batchUniverse[1][np.ix_(inds, inds)]
+        else:
+            rExps, rCoDispSq = problem[0], problem[1]
+            if len(problem) > 2:
+                constraintSet = problem[2]
+        return _solve_batch_problem(np.asarray(rExps), np.asarray(rCoDispSq), constraintSet, 
+                target, riskFreeRate, annualizeBy, solver) + (None,)
+    except (OptimizationError, np.linalg.LinAlgError) as e:
+        # one failed problem should not stop the batch
+        return None, np.nan, False, str(e)
+
+@profiling.profiled('portOpt.batch_optimize')
+def batch_optimize(problems, target='Sharpe Ratio', riskFreeRate=0, constraintSet=(0, 1), 
+        annualizeBy='None', solver='SLSQP', universe=None, nProc=None, chunkSize=None):
+    """Optimize many portfolios across a pool of worker processes.
+
+    :param problems:    list, either (rExps, rCoDispSq) or 
+                        (rExps, rCoDispSq, constraintSet) tuples, 
+                        or if universe is passed, int arrays of asset 
+                        indices into the universe
+    :param target:  str, 'Sharpe Ratio' (max), 'Dispersion' (min) or 
+                    'HRP' (hierarchical risk parity, no solver)
+    :param riskFreeRate:    float, for the Sharpe ratio, annualized if 
+                            annualizeBy is set
+    :param constraintSet:   (float, float), weight bounds used when a 
+                            problem does not give its own
+    :param annualizeBy: str, time frame of the returns (see genFin.annualize)
+    :param solver:  str, 'SLSQP' or 'QP' (long only, see max_sharpe_ratio_qp)
+    :param universe:    (float array, float array 2D), shared expected return 
+                        vector and co-dispersion squared matrix
+    :param nProc:   int, number of worker processes, default cpu count, 
+                    1 solves in this process
+    :param chunkSize:   int, problems handed to a worker at a time, 
+                        default splits the batch in about 4 chunks per worker
+    :return weights:    float array 2D, one row per problem, for index 
+                        subsets the columns are the universe assets (zero 
+                        outside the subset), otherwise padded with nan to 
+                        the largest problem
+    :return fun:    float array, objective value per problem (negative 
+                    Sharpe ratio or dispersion)
+    :return success:    bool array, optimizer status per problem, a 
+                        problem the solver raised on has nan weights 
+                        and a warning is printed
+    """
+    if target not in ('Sharpe Ratio', 'Dispersion', 'HRP'):
+        raise Exception('Target set for optimization not known: '+target)
+    nProb = len(problems)
+    if universe is not None:
+        universe = (np.asarray(universe[0]), np.asarray(universe[1]))
+        m = len(universe[0])
+    elif nProb == 0:
+        m = 0
+    else:
+        m = max(len(problem[0]) for problem in problems)
+    if nProb == 0:
+        # nothing to solve, no pool
+        return np.zeros((0, m)), np.zeros(0), np.zeros(0, dtype=bool)
+
+    tasks = [(problem, constraintSet, target, riskFreeRate, annualizeBy, solver) 
+            for problem in problems]
+
+    if nProc == 1:
+        _init_batch_worker(universe)
+        try:
+            results = [_batch_worker(task) for task in tasks]
+        finally:
+            _init_batch_worker(None)
+    else:
+        if nProc is None:
+            nProc = mp.cpu_count()
+        if chunkSize is None:
+            chunkSize = max(1, int(np.ceil(nProb / (4 * nProc))))
+        with mp.Pool(processes=nProc, initializer=_init_batch_worker, initargs=(universe,)) as pool:
+            results = pool.map(_batch_worker, tasks, chunksize=chunkSize)
+
+    if universe is not None:
+        weights = np.zeros((nProb, m))
+    else:
+        weights = np.zeros((nProb, m)) * np.nan
+    fun = np.zeros(nProb) * np.nan
+    success = np.zeros(nProb, dtype=bool)
+    nFailed = 0
+    for i, (x, f, ok, error) in enumerate(results):
+        if x is None:
+            if nFailed == 0:
+                print('Warning: batch problem '+str(i)+' failed: '+error)
+            nFailed += 1
+            weights[i] = np.nan
+            continue
+        if universe is not None:
+            weights[i, np.asarray(problems[i])] = x
+        else:
+            weights[i, :len(x)] = x
+        fun[i] = f
+        success[i] = ok
+    if nFailed > 1:
+        print('Warning: '+str(nFailed)+' of '+str(nProb)+' batch problems failed.')
 
+    return weights, fun, success
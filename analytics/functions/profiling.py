@@ -0,0 +1,155 @@
+# This module contains opt-in profiling hooks for the portfolio pipeline.
+# The main stages (loading, returns, co-dispersion, the optimizers and
+# the curves) are decorated with profiled, other code can be timed with
+# the stage context manager. While profiling is disabled (the default)
+# a decorated call only costs one flag check.
+#
+# Per stage the number of calls, the wall time (in total and excluding
+# nested stages) and the largest array shape seen are recorded, the
+# report is a dict (or JSON) of the stages since the last reset.
+#
+#   from functions import profiling
+#   profiling.enable()
+#   portfolio.update_properties(...)
+#   plotter.get_curves()
+#   print(profiling.report_json())
+#
+# Only the calling process is recorded, work done in worker processes
+# (nProc > 1) shows up as the time of the stage that started them.
+#
+# There is no warranty or guarantee of any kind
+
+import time
+import json
+import functools
+import contextlib
+
+import numpy as np
+
+
+_enabled = False
+# stage name to its record
+_records = {}
+# running stages, each [name, start time, time spent in nested stages]
+_stack = []
+
+
+def enable():
+    """Start recording stages."""
+    global _enabled
+    _enabled = True
+
+def disable():
+    """Stop recording stages, the records are kept (see reset)."""
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    """:return:    bool, true if stages are recorded"""
+    return _enabled
+
+def reset():
+    """Clear all records."""
+    _records.clear()
+    del _stack[:]
+
+
+def _record(name, seconds, selfSeconds, shape):
+    rec = _records.get(name)
+    if rec is None:
+        rec = {'calls': 0, 'seconds': 0.0, 'selfSeconds': 0.0, 'maxSeconds': 0.0,
+                'maxShape': None}
+        _records[name] = rec
+    rec['calls'] += 1
+    rec['seconds'] += seconds
+    rec['selfSeconds'] += selfSeconds
+    rec['maxSeconds'] = max(rec['maxSeconds'], seconds)
+    if shape is not None:
+        if rec['maxShape'] is None or np.prod(shape) > np.prod(rec['maxShape']):
+            rec['maxShape'] = [int(s) for s in shape]
+
+
+@contextlib.contextmanager
+def stage(name, shape=None):
+    """Context manager recording the enclosed code as a stage.
+
+    :param name:    str, stage name
+    :param shape:   tuple, size of the data worked on (optional)
+    """
+    if not _enabled:
+        yield
+        return
+    entry = [name, time.perf_counter(), 0.0]
+    _stack.append(entry)
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - entry[1]
+        _stack.pop()
+        if _stack:
+            # parent stage time excludes this one in its self time
+            _stack[-1][2] += seconds
+        _record(name, seconds, seconds - entry[2], shape)
+
+
+def _largest_shape(args, kwargs):
+    # shape of the largest array argument
+    shape = None
+    for a in list(args) + list(kwargs.values()):
+        if isinstance(a, np.ndarray) and (shape is None or a.size > np.prod(shape)):
+            shape = a.shape
+    return shape
+
+def profiled(name=None, shapeOf=None):
+    """Decorator recording each call of a function as a stage.
+
+    :param name:    str, stage name, default the function's qualified name
+    :param shapeOf: function of the call arguments returning the shape
+                    of the data worked on, default the shape of the
+                    largest array argument
+    """
+    def decorator(func):
+        stageName = name if name is not None else func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            if shapeOf is not None:
+                shape = shapeOf(*args, **kwargs)
+            else:
+                shape = _largest_shape(args, kwargs)
+            with stage(stageName, shape=shape):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report():
+    """Records since the last reset.
+
+    :return:    dict, stage name to its record (calls, seconds,
+                selfSeconds, maxSeconds, maxShape), the stages with
+                the most time first
+    """
+    names = sorted(_records, key=lambda n: _records[n]['seconds'], reverse=True)
+    return {n: dict(_records[n]) for n in names}
+
+def report_json(path=None):
+    """Records since the last reset as JSON (see report).
+
+    :param path:    str, if passed the JSON is also written to this file
+    :return:    str, JSON text
+    """
+    text = json.dumps(report(), indent=1)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(text)
+    return text
+
+def print_report():
+    """Print the records since the last reset as a table."""
+    print('%-45s %7s %10s %10s  %s' % ('stage', 'calls', 'seconds', 'self', 'max shape'))
+    for n, rec in report().items():
+        print('%-45s %7d %10.4f %10.4f  %s' % (n, rec['calls'], rec['seconds'],
+            rec['selfSeconds'], rec['maxShape']))
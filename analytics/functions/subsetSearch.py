@@ -0,0 +1,120 @@
+# This module contains a search for the best k asset subsets of a
+# universe, e.g. picking the 3 assets of a portfolio out of a few
+# hundred pre-assessed symbols, by their max Sharpe ratio.
+#
+# Trying all subsets is combinatorially impossible, instead subsets
+# are grown one asset at a time by beam search: every subset in the
+# beam is extended by every remaining candidate, each extension is
+# scored by its long only max Sharpe ratio (the QP solver in portOpt)
+# and only the best beamWidth subsets are kept for the next step.
+# A beam width of one is the plain greedy search.
+#
+# The universe expected returns and co-dispersion squared matrix are
+# computed once (e.g. a Portfolio over the whole universe), each
+# candidate only gathers its k x k sub matrix. numpy cannot view an
+# arbitrary index subset without copying, but the k x k gather is
+# tiny next to the solve and the universe matrix is never copied.
+#
+# There is no warranty or guarantee of any kind
+
+import numpy as np
+
+from . import genFin as gf
+from . import portOpt as po
+
+
+def _subset_sharpe(rExps, rCoDispSq, inds, riskFreeRate, annualizeBy, singleSR):
+    # max Sharpe ratio and weights of the subset inds
+    rExpsSub = rExps[inds]
+    rCoDispSqSub = rCoDispSq[np.ix_(inds, inds)]
+    try:
+        res = po.max_sharpe_ratio_qp(rExpsSub, rCoDispSqSub, riskFreeRate=riskFreeRate,
+                annualizeBy=annualizeBy)
+        return -res['fun'], res['x']
+    except (po.OptimizationError, np.linalg.LinAlgError):
+        # no asset beats the risk free rate (or the solve failed),
+        # fall back to the best single asset of the subset
+        j = int(np.argmax(singleSR[inds]))
+        w = np.zeros(len(inds))
+        w[j] = 1
+        return singleSR[inds][j], w
+
+
+def best_subsets(rExps, rCoDispSq, k, beamWidth=10, nTop=10, riskFreeRate=0,
+        annualizeBy='None', candidates=None, include=None, syms=None):
+    """Search for the k asset subsets of a universe with the highest
+    long only max Sharpe ratio by beam search.
+
+    :param rExps:   float array, universe asset expected returns, length n
+    :param rCoDispSq:   float array 2D, universe co-dispersion squared
+                        matrix, nxn
+    :param k:   int, number of assets in a subset
+    :param beamWidth:   int, subsets kept between steps, 1 is greedy
+    :param nTop:    int, number of best subsets to return
+    :param riskFreeRate:    float, annualized if annualizeBy is set
+    :param annualizeBy: str, time frame of the returns (see genFin.annualize)
+    :param candidates:  int array, universe indices to pick from,
+                        default all assets with finite statistics
+    :param include: int array, universe indices always in the subset
+    :param syms:    str array, universe symbols, if passed the subsets
+                    are returned as symbols
+    :return subsets:    array 2D, nTop x k universe indices (or symbols),
+                        best first
+    :return sharpeRatios:   float array, max Sharpe ratio per subset
+    :return weights:    float array 2D, nTop x k optimal weights
+                        corresponding to subsets
+    """
+    rExps = np.asarray(rExps, dtype=float)
+    rCoDispSq = np.asarray(rCoDispSq, dtype=float)
+    annFact = gf.annualize_factor(annualizeBy)
+
+    if candidates is None:
+        ok = np.isfinite(rExps) & np.isfinite(np.diag(rCoDispSq))
+        candidates = np.where(ok)[0]
+    candidates = np.asarray(candidates, dtype=int)
+    if include is None:
+        include = []
+    include = [int(i) for i in include]
+    if len(include) > k:
+        raise Exception('More assets to include than the subset size k.')
+    candidates = np.array([i for i in candidates if i not in include], dtype=int)
+    if len(include) + len(candidates) < k:
+        raise Exception('Not enough candidate assets for subsets of size '+str(k)+'.')
+
+    # single asset Sharpe ratios, the fallback score
+    with np.errstate(invalid='ignore', divide='ignore'):
+        singleSR = (annFact * rExps - riskFreeRate) / np.sqrt(annFact * np.diag(rCoDispSq))
+
+    # beam entries are (score, sorted index tuple, weights)
+    if len(include) > 0:
+        inds = sorted(include)
+        score, w = _subset_sharpe(rExps, rCoDispSq, inds, riskFreeRate, annualizeBy, singleSR)
+        beam = [(score, tuple(inds), w)]
+    else:
+        beam = [(-np.inf, (), np.zeros(0))]
+
+    for step in range(len(include), k):
+        # keep more at the last step so nTop can be returned
+        keep = beamWidth if step < k - 1 else max(beamWidth, nTop)
+        scored = {}
+        for _, subset, _ in beam:
+            for j in candidates:
+                if j in subset:
+                    continue
+                newSubset = tuple(sorted(subset + (int(j),)))
+                if newSubset in scored:
+                    # reached from another subset in the beam
+                    continue
+                scored[newSubset] = _subset_sharpe(rExps, rCoDispSq, list(newSubset),
+                        riskFreeRate, annualizeBy, singleSR)
+        ranked = sorted(scored.items(), key=lambda item: item[1][0], reverse=True)
+        beam = [(score, subset, w) for subset, (score, w) in ranked[:keep]]
+
+    beam = beam[:nTop]
+    subsets = np.array([subset for _, subset, _ in beam], dtype=int)
+    sharpeRatios = np.array([score for score, _, _ in beam])
+    weights = np.array([w for _, _, w in beam])
+    if syms is not None:
+        subsets = np.asarray(syms)[subsets]
+
+    return subsets, sharpeRatios, weights
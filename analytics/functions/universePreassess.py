@@ -0,0 +1,216 @@
+# This module runs the asset pre-assessment steps (see assetPreassess.py)
+# over a full universe of assets, for example every symbol in a
+# PriceLoader data file, using a pool of worker processes.
+#
+# The steps follow the project notebooks (e.g. 202411_apa_SP500):
+# - Monthly returns and the sampling interval from the return acf
+# - Best simple trend model fit to the sampled prices
+# - Deviation threshold and deviation events around the trend
+# - Running returns over increasingly longer hold times
+# One compact row of results is written per asset to a flat file.
+# Rows are written as soon as an asset is done so an interrupted
+# run can be picked up again by calling with the same output file.
+#
+# There is no warranty or guarantee of any kind
+
+import os
+import csv
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+from . import genStats as gs
+from . import genFin as gf
+from . import assetPreassess as apa
+
+
+# default parameters, taken from the SP500 pre-assessment notebook
+
+defaultParams = {
+        'month2days': 21,
+        'acfCutoff': 0.05,
+        'fracLag': 0.1,
+        'maxPolyOrder': 5,
+        'devCutoff': 0,
+        'devMethod': 'MAD',
+        'maxHoldFrac': 0.666,
+        'minObs': 252
+        }
+
+# columns of the summary table, in order
+summaryHeader = ['Symbol', 'Status', 'Start', 'End', 'NumObs', 'SampFreq',
+        'TrendModel', 'TrendRsqAdj', 'DevThresh', 'NumEvents',
+        'EventExpDays', 'EventAbnormalDays', 'HoldYears', 'HoldReturn',
+        'AnnualReturn']
+
+
+def preassess_asset(sym, dates, prices, params=None):
+    """Run the pre-assessment steps on a single asset and
+    summarize the results in one row.
+
+    :param sym: str, asset symbol
+    :param dates:   datetime array, n dates for the price history
+    :param prices:  float array, n prices, nan values (e.g. before
+                    listing) are removed prior to the analysis
+    :param params:  dict, overrides for the values in defaultParams
+    :return row:    dict, summary values keyed by summaryHeader,
+                    Status is 'OK' or a short reason the asset
+                    could not be fully assessed
+    """
+    p = dict(defaultParams)
+    if params is not None:
+        p.update(params)
+    month2days = p['month2days']
+
+    row = dict.fromkeys(summaryHeader, np.nan)
+    row['Symbol'] = sym
+
+    inds = ~np.isnan(prices)
+    dates = dates[inds]
+    prices = prices[inds]
+    n = len(prices)
+    row['NumObs'] = n
+    if n < p['minObs']:
+        row['Status'] = 'Too few observations'
+        return row
+    row['Start'] = dates[0]
+    row['End'] = dates[-1]
+
+    # sampling interval from the return acf
+    returns = gf.returns(prices, period=month2days)
+    sampFreq = apa.find_samp_freq(returns, cutoff=p['acfCutoff'],
+            period=month2days, fracLag=p['fracLag'])
+    if sampFreq >= n/2:
+        # find_samp_freq returns a large number if no interval was found
+        row['Status'] = 'No sampling interval'
+        return row
+    row['SampFreq'] = sampFreq
+
+    # trend fit on the sampled prices
+    x = np.arange(0, n, 1)
+    sampInds = np.arange(0, n, sampFreq)
+    rsqAdj, name, model, prices_sampHat = gs.fit_simp_model(x[sampInds],
+            prices[sampInds], p['maxPolyOrder'])
+    if name == '':
+        row['Status'] = 'No trend model'
+        return row
+    row['TrendModel'] = name
+    row['TrendRsqAdj'] = rsqAdj
+
+    # deviation threshold from the sampled deviations
+    cutoff = p['devCutoff']
+    devs = gf.dev(prices[sampInds][cutoff:], np.asarray(prices_sampHat)[cutoff:])
+    thresh = gs.disper(devs, method=p['devMethod'])
+    row['DevThresh'] = thresh
+
+    # deviation events on the monthly prices against the full trend
+    pricesHat = gs.run_model(x, model, name)
+    monthInds = np.arange(0, n, month2days)[cutoff:]
+    eventInd, eventTime, eventLength = apa.flag_dev_event(dates[monthInds],
+            prices[monthInds], pricesHat[monthInds], thresh)
+    row['NumEvents'] = len(eventTime)
+    if len(eventLength) > 0:
+        eventDays = np.array(eventLength, dtype='timedelta64[ns]') / np.timedelta64(1, 'D')
+        eventExp = np.median(eventDays)
+        row['EventExpDays'] = eventExp
+        row['EventAbnormalDays'] = eventExp + gs.disper(eventDays, method=p['devMethod'])
+
+    # running returns over the longest hold time considered
+    returnHist, returnHistDisp, returnHistTime = apa.calc_running_returns(prices[sampInds],
+            maxHoldFrac=p['maxHoldFrac'])
+    holdYears = returnHistTime[-1] * sampFreq / month2days / 12
+    row['HoldYears'] = holdYears
+    row['HoldReturn'] = returnHist[-1]
+    if holdYears > 0:
+        row['AnnualReturn'] = returnHist[-1] / holdYears
+
+    row['Status'] = 'OK'
+    return row
+
+
+def _preassess_worker(args):
+    # unpack for the pool and never let one asset stop the whole run
+    sym, dates, prices, params = args
+    try:
+        row = preassess_asset(sym, dates, prices, params=params)
+    except Exception as e:
+        row = dict.fromkeys(summaryHeader, np.nan)
+        row['Symbol'] = sym
+        row['Status'] = 'Error: '+str(e)
+    return row
+
+
+def load_summary(path):
+    """Load a summary table written by preassess_universe.
+
+    :param path:    str, path to the summary file
+    :return:    pandas dataframe, one row per assessed asset
+    """
+    return pd.read_csv(path, parse_dates=['Start', 'End'])
+
+
+def preassess_universe(priceLoader, path, syms=None, params=None, nProc=None,
+        chunkSize=1, verb=True):
+    """Run the pre-assessment on every asset of a price universe
+    across a process pool and write a summary table to path.
+
+    Resumable: if path already exists, symbols already in it are
+    skipped and new rows are appended, so a stopped run can simply
+    be started again with the same arguments. Rows of assets that
+    raised an error (Status 'Error: ...', e.g. a temporary fetch
+    failure) are dropped from the file and those assets are retried.
+
+    :param priceLoader: PriceLoader, points to the long flat file
+                        of the universe (see CondorCoreObs)
+    :param path:    str, path for the summary (csv) file
+    :param syms:    str list, symbols to assess, default the loader's
+                    target symbols or all symbols in the loader file
+                    if none are set
+    :param params:  dict, overrides for the values in defaultParams
+    :param nProc:   int, number of worker processes, default is
+                    the cpu count
+    :param chunkSize:   int, assets handed to a worker at a time
+    :param verb:    bool, print progress if true
+    :return:    pandas dataframe, the full summary table
+    """
+
+    # one read for the whole universe, the loader is left as it is
+    assetSet = priceLoader.load_asset_set(syms=syms)
+    prices, dates, allSyms = assetSet.prices, assetSet.dates, assetSet.syms
+
+    done = set()
+    if os.path.exists(path):
+        # read as text so the kept rows are written back unchanged
+        summary = pd.read_csv(path, dtype=str, keep_default_na=False)
+        failed = summary['Status'].str.startswith('Error')
+        if failed.any():
+            summary[~failed].to_csv(path, index=False)
+            if verb:
+                print(str(int(failed.sum()))+' assets failed with an error in '+path+'. Retrying those.')
+        done = set(summary['Symbol'][~failed])
+        if verb:
+            print(str(len(done))+' assets already assessed in '+path+'. Skipping those.')
+
+    tasks = [(str(allSyms[i]), dates, prices[:, i], params)
+            for i in range(len(allSyms)) if str(allSyms[i]) not in done]
+
+    writeHeader = not os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=summaryHeader)
+        if writeHeader:
+            writer.writeheader()
+            f.flush()
+
+        with mp.Pool(processes=nProc) as pool:
+            count = 0
+            for row in pool.imap_unordered(_preassess_worker, tasks, chunksize=chunkSize):
+                writer.writerow(row)
+                # flush each row so an interruption loses at most the running assets
+                f.flush()
+                count += 1
+                if verb:
+                    print(f"{count}/{len(tasks)} {row['Symbol']}: {row['Status']}")
+
+    return load_summary(path)
+
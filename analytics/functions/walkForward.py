@@ -0,0 +1,231 @@
+# This module contains a walk-forward portfolio optimization engine.
+# A window of fixed length slides over a price matrix by a fixed step,
+# at each step the asset return statistics (expected returns and the
+# co-dispersion squared matrix) are re-estimated on the window and the
+# portfolio is re-optimized.
+#
+# The returns are calculated once for the whole price matrix. For the
+# Normal method the statistics are kept up to date incrementally, only
+# the sampled return rows that enter or leave the window are added or
+# removed, rather than re-estimated from scratch. Each re-optimization
+# starts from the previous window's weights. Independent runs of
+# windows can be spread across worker processes.
+#
+# There is no warranty or guarantee of any kind
+
+import numpy as np
+import multiprocessing as mp
+
+from . import genFin as gf
+from . import portOpt as po
+
+
+# consecutive rows (open trading days) per return time frame,
+# same assumption as CondorCoreObs.Returns
+timePeriods = {'D': 1, 'W': 5, 'M': 21, 'Q': 21*3, 'Y': 21*12}
+
+
+def _moments_init(n):
+    # pairwise sums for nan aware means and covariances:
+    # counts, sums of x_i where x_j is present, sums of x_i x_j
+    return [np.zeros((n, n)), np.zeros((n, n)), np.zeros((n, n))]
+
+def _moments_update(mom, x, sign=1):
+    # add (sign=1) or remove (sign=-1) the rows x
+    mask = ~np.isnan(x)
+    x0 = np.where(mask, x, 0)
+    m = mask.astype(float)
+    mom[0] += sign * (m.T @ m)
+    mom[1] += sign * (x0.T @ m)
+    mom[2] += sign * (x0.T @ x0)
+
+def _moments_stats(mom):
+    # means and covariances (ddof=1) from the pairwise sums, these match
+    # genFin.returnExp and returnCoDispSq with the Normal method
+    count, sx, sxy = mom
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rExps = np.diag(sx) / np.diag(count)
+        rCoDispSq = (sxy - sx * sx.T / count) / (count - 1)
+    return rExps, rCoDispSq
+
+def _optimize_window(rExps, rCoDispSq, active, initGuess, target, riskFreeRate,
+        annualizeBy, solver, constraintSet):
+    # optimize over the assets with data in this window, others get zero weight
+    n = len(rExps)
+    w = np.zeros(n)
+    inds = np.where(active)[0]
+    if len(inds) == 0:
+        return w*np.nan, False
+    rExps = rExps[inds]
+    rCoDispSq = rCoDispSq[np.ix_(inds, inds)]
+
+    if initGuess is not None:
+        initGuess = initGuess[inds]
+        if not np.all(np.isfinite(initGuess)) or np.sum(initGuess) <= 0:
+            initGuess = None
+        else:
+            initGuess = initGuess / np.sum(initGuess)
+
+    try:
+        if target == 'Sharpe Ratio':
+            if solver == 'QP':
+                res = po.max_sharpe_ratio_qp(rExps, rCoDispSq, riskFreeRate=riskFreeRate,
+                        constraintSet=constraintSet, annualizeBy=annualizeBy)
+            else:
+                res = po.max_sharpe_ratio(rExps, rCoDispSq, riskFreeRate=riskFreeRate,
+                        constraintSet=constraintSet, annualizeBy=annualizeBy, initGuess=initGuess)
+        elif target == 'Dispersion':
+            if solver == 'QP':
+                res = po.min_dispersion_qp(rExps, rCoDispSq, constraintSet=constraintSet,
+                        annualizeBy=annualizeBy)
+            else:
+                res = po.min_dispersion(rExps, rCoDispSq, constraintSet=constraintSet,
+                        annualizeBy=annualizeBy, initGuess=initGuess)
+        else:
+            raise Exception('Target set for optimization not known: '+target)
+    except (po.OptimizationError, np.linalg.LinAlgError):
+        # e.g. no asset beats the risk free rate in this window (QP), 
+        # a failed window, the walk goes on
+        return w*np.nan, False
+
+    w[inds] = res['x']
+    return w, bool(res['success'])
+
+def _walk_chunk(args):
+    # run a contiguous set of windows in order, sampled return rows
+    # (rSamp) are at the return row indices sampRows
+    (rSamp, sampRows, starts, stops, method, minObs, target, riskFreeRate,
+            annualizeBy, solver, constraintSet) = args
+    nWin = len(starts)
+    n = rSamp.shape[1]
+    weights = np.zeros((nWin, n)) * np.nan
+    success = np.zeros(nWin, dtype=bool)
+
+    # window edges as positions in the sampled rows
+    lo = np.searchsorted(sampRows, starts, side='left')
+    hi = np.searchsorted(sampRows, stops, side='left')
+
+    mom = _moments_init(n)
+    curLo, curHi = 0, 0
+    wPrev = None
+    for k in range(nWin):
+        if method == 'Normal':
+            if lo[k] >= curHi or hi[k] <= curLo:
+                # no overlap with the last window, start over
+                mom = _moments_init(n)
+                curLo, curHi = lo[k], lo[k]
+            # add rows entering and remove rows leaving the window
+            if hi[k] > curHi:
+                _moments_update(mom, rSamp[curHi:hi[k]], 1)
+            elif hi[k] < curHi:
+                _moments_update(mom, rSamp[hi[k]:curHi], -1)
+            if lo[k] > curLo:
+                _moments_update(mom, rSamp[curLo:lo[k]], -1)
+            elif lo[k] < curLo:
+                _moments_update(mom, rSamp[lo[k]:curLo], 1)
+            curLo, curHi = lo[k], hi[k]
+            rExps, rCoDispSq = _moments_stats(mom)
+            counts = np.diag(mom[0])
+        else:
+            # no incremental form for the robust statistics,
+            # the window is a view of the sampled rows
+            r = rSamp[lo[k]:hi[k]]
+            counts = np.sum(~np.isnan(r), axis=0)
+            rExps = np.zeros(n) * np.nan
+            rCoDispSq = np.zeros((n, n)) * np.nan
+            inds = np.where(counts >= minObs)[0]
+            if len(inds) > 0:
+                rExps[inds] = gf.returnExp(r[:, inds], method=method)
+                rCoDispSq[np.ix_(inds, inds)] = gf.returnCoDispSq(r[:, inds], method=method)
+
+        active = _finite_active(counts >= minObs, rExps, rCoDispSq)
+        weights[k], success[k] = _optimize_window(rExps, rCoDispSq, active, wPrev, target,
+                riskFreeRate, annualizeBy, solver, constraintSet)
+        if success[k]:
+            wPrev = weights[k]
+
+    return weights, success
+
+def _finite_active(active, rExps, rCoDispSq):
+    # drop assets whose statistics are not finite within the active set
+    inds = np.where(active)[0]
+    sub = rCoDispSq[np.ix_(inds, inds)]
+    ok = np.isfinite(rExps[inds]) & np.all(np.isfinite(sub), axis=0)
+    out = np.zeros(len(active), dtype=bool)
+    out[inds[ok]] = True
+    return out
+
+
+def walk_forward(prices, window, step, timeFrame='M', metric='Relative', method='Normal',
+        sampInt=20, target='Sharpe Ratio', riskFreeRate=0, annualize=True, solver='SLSQP',
+        constraintSet=(0, 1), minObs=10, nProc=1):
+    """Walk-forward re-estimation and re-optimization over a price matrix.
+
+    Window k covers the price rows [k*step, k*step+window), its returns
+    are those with both prices inside the window, sampled every sampInt
+    return rows counted from the first row of the price matrix (so all
+    windows share the same sample phase).
+
+    :param prices:  float array 2D, rows as consecutive dates, cols as
+                    assets (nan before an asset's data starts)
+    :param window:  int, window length in price rows
+    :param step:    int, rows between consecutive windows
+    :param timeFrame:   str, return time frame 'D', 'W', 'M', 'Q' or 'Y'
+    :param metric:  str, return metric (see genFin.returns)
+    :param method:  str, 'Normal' (incremental statistics) or 'Robust'
+                    (re-estimated per window)
+    :param sampInt: int, sampling interval of the returns
+    :param target:  str, 'Sharpe Ratio' (max) or 'Dispersion' (min)
+    :param riskFreeRate:    float, annualized if annualize is true
+    :param annualize:   bool, annualize by the time frame
+    :param solver:  str, 'SLSQP' (warm started) or 'QP' (see portOpt)
+    :param constraintSet:   (float, float), weight bounds
+    :param minObs:  int, minimum sampled returns in a window for an asset
+                    to be included, others get zero weight
+    :param nProc:   int, number of worker processes, the windows are split
+                    into nProc contiguous runs (warm starts run within a run)
+    :return weights:    float array 2D, weight history, one row per window
+    :return ends:   int array, price row index of the last row in each window
+    :return success:    bool array, optimizer status per window
+    """
+    if timeFrame not in timePeriods:
+        raise Exception('The time frame '+timeFrame+' is not known.')
+    period = timePeriods[timeFrame]
+    if window <= period + sampInt:
+        raise Exception('The window must be longer than the return period plus the sampling interval.')
+    if annualize:
+        annualizeBy = timeFrame
+    else:
+        annualizeBy = 'None'
+
+    prices = np.asarray(prices, dtype=float)
+    if prices.ndim == 1:
+        prices = prices.reshape(-1, 1)
+    nRows = prices.shape[0]
+
+    # returns once for everything, then keep only the sampled rows
+    r = gf.returns(prices, period=period, metric=metric)
+    sampRows = np.arange(0, len(r), sampInt)
+    # a strided view, same rows as r[sampRows] without the copy
+    rSamp = r[::sampInt]
+
+    starts = np.arange(0, nRows - window + 1, step)
+    # return row i uses price rows i and i+period
+    stops = starts + window - period
+    ends = starts + window - 1
+
+    nChunks = max(1, min(nProc, len(starts)))
+    chunks = np.array_split(np.arange(len(starts)), nChunks)
+    tasks = [(rSamp, sampRows, starts[inds], stops[inds], method, minObs, target,
+            riskFreeRate, annualizeBy, solver, constraintSet) for inds in chunks]
+
+    if len(tasks) > 1:
+        with mp.Pool(processes=len(tasks)) as pool:
+            results = pool.map(_walk_chunk, tasks)
+    else:
+        results = [_walk_chunk(tasks[0])]
+
+    weights = np.concatenate([res[0] for res in results])
+    success = np.concatenate([res[1] for res in results])
+
+    return weights, ends, success